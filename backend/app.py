@@ -1,97 +1,223 @@
 import json
 import logging
 import os
-import re
-from time import time
+from time import perf_counter, time
 
 import numpy as np
 import onnxruntime as ort
-from utils import pad_sequences, tokenizer_from_json
-from youtube_transcript_api import YouTubeTranscriptApi
-from youtube_transcript_api.proxies import GenericProxyConfig
+import orjson
+from cache import ResultCache, file_digest
+from metrics import REQUESTS, Gauge, StageTimer
+from scheduler import InferenceScheduler
+from segments import parse_options, summarize
+from singleflight import SingleFlight
+from transcript import TranscriptClient
+from utils import TranscriptEncoder, tokenizer_from_json
+from vocab import Vocabulary
+from windows import (MAX_LEN, OVERLAP, prepare_X, run_buckets,
+                     stitch_predictions, window_lengths)
 
-MAX_LEN = 3000
-OVERLAP = 800
 TOKENIZER = os.path.join('.', 'model', 'tokenizer.json')
-MODEL = os.path.join('.', 'model', 'model.onnx')
+VOCAB = os.path.join('.', 'model', 'vocab')
+MODELS = {'fp32': os.path.join('.', 'model', 'model.onnx'),
+          'int8': os.path.join('.', 'model', 'model.int8.onnx')}
+MODEL_VARIANT = os.environ.get('MODEL_VARIANT', 'fp32')
+if MODEL_VARIANT not in MODELS:
+    raise ValueError(f'Unknown MODEL_VARIANT {MODEL_VARIANT}, '
+                     f'choose one of {", ".join(MODELS)}')
+MODEL = MODELS[MODEL_VARIANT]
+BATCH_SIZE = int(os.environ.get('INFERENCE_BATCH_SIZE', 16))
+MAX_BATCH_VIDEOS = 50
+# split the cores between the server's worker processes, see serve.py
+WORKERS = int(os.environ.get('WORKERS', 1))
+INTRA_OP_THREADS = int(os.environ.get(
+    'ORT_INTRA_OP_THREADS', max(1, (os.cpu_count() or 1) // WORKERS)))
+INTER_OP_THREADS = int(os.environ.get('ORT_INTER_OP_THREADS', 1))
 
-model = ort.InferenceSession(MODEL)
-with open(TOKENIZER, 'r') as fp:
-    json_str = json.load(fp)
-    tokenizer = tokenizer_from_json(json_str)
 
+def load_model(path=MODEL):
+    options = ort.SessionOptions()
+    options.intra_op_num_threads = INTRA_OP_THREADS
+    options.inter_op_num_threads = INTER_OP_THREADS
+    if INTER_OP_THREADS > 1:
+        options.execution_mode = ort.ExecutionMode.ORT_PARALLEL
+    return ort.InferenceSession(path, options)
+
+
+def after_fork():
+    """
+    Recreate the model session in a forked worker if it uses thread pools,
+    which are not copied by fork. A single threaded session stays shared
+    copy-on-write with the parent process
+    """
+    global model
+    if INTRA_OP_THREADS != 1 or INTER_OP_THREADS > 1:
+        model = load_model()
+
+
+t_load = perf_counter()
+model = load_model()
+# optional sequence length buckets, e.g. "512,1024,2048,3000". Windows run at
+# the smallest bucket that fits them, which needs a model with a dynamic time axis
+BUCKETS = tuple(sorted({int(b) for b in os.environ.get(
+    'INFERENCE_BUCKETS', '').split(',') if b.strip()} | {MAX_LEN}))
+if len(BUCKETS) > 1 and isinstance(model.get_inputs()[0].shape[1], int):
+    logging.warning('Model has a fixed time axis, ignore INFERENCE_BUCKETS')
+    BUCKETS = (MAX_LEN,)
+
+# coalesce the windows of concurrent requests into shared model runs
+scheduler = None
+if os.environ.get('INFERENCE_SCHEDULER', '').lower() in ('1', 'true', 'yes'):
+    max_batch = int(os.environ.get('INFERENCE_MAX_BATCH', BATCH_SIZE))
+    scheduler = InferenceScheduler(
+        lambda X: run_batches(X, max_batch),
+        max_batch=max_batch,
+        max_wait=float(os.environ.get('INFERENCE_MAX_WAIT_MS', 5)) / 1000)
+
+# the encoder is loaded on first use, see get_encoder
+encoder = None
+
+# shared across requests, replace it to fetch from a stand-in server in tests
+transcript_client = TranscriptClient.from_env()
 
 VERSION = '2022-03-27'
 
+# results are only valid for the code version and the exact model files. The
+# compact vocabulary is only used while it matches tokenizer.json
+TOKENIZER_DIGEST = file_digest(TOKENIZER)
+result_cache = ResultCache(
+    namespace=f'{VERSION}:{file_digest(MODEL, TOKENIZER)}',
+    max_size=int(os.environ.get('RESULT_CACHE_SIZE', 256)),
+    ttl=float(os.environ.get('RESULT_CACHE_TTL', 86400)),
+    path=os.environ.get('RESULT_CACHE_PATH'))
+Gauge('sponsor_result_cache_hits_total', 'Result cache hits',
+      lambda: result_cache.hits, 'counter')
+Gauge('sponsor_result_cache_misses_total', 'Result cache misses',
+      lambda: result_cache.misses, 'counter')
+
+# seconds to remember that a video has no usable transcript, by error class,
+# e.g. "NoTranscriptFound=3600,TranscriptsDisabled=86400" in NEGATIVE_CACHE_TTLS.
+# Other errors, like TooManyRequests, are transient and never cached
+NEGATIVE_TTLS = {'NoTranscriptFound': 6 * 3600,  # captions can be added later
+                 'TranscriptsDisabled': 86400,
+                 'VideoUnavailable': 86400,
+                 'InvalidVideoId': 7 * 86400}
+NEGATIVE_TTLS.update(
+    (name.strip(), float(ttl)) for name, ttl in
+    (item.split('=') for item in
+     os.environ.get('NEGATIVE_CACHE_TTLS', '').split(',') if item.strip()))
+# errors don't depend on the model. Like the result cache, every worker opens
+# its own connection to the SQLite file, so they share the remembered errors
+negative_cache = ResultCache(
+    namespace=VERSION,
+    max_size=int(os.environ.get('NEGATIVE_CACHE_SIZE', 4096)),
+    path=os.environ.get('RESULT_CACHE_PATH'),
+    table='negative')
+Gauge('sponsor_negative_cache_hits_total', 'Negative cache hits',
+      lambda: negative_cache.hits, 'counter')
+
+# concurrent requests for the same video share one fetch & inference
+in_flight = SingleFlight()
+SINGLE_FLIGHT_TIMEOUT = float(os.environ.get('SINGLE_FLIGHT_TIMEOUT', 60))
+Gauge('sponsor_single_flight_deduplicated_total',
+      'Requests that waited for a running request for the same video',
+      lambda: in_flight.deduplicated, 'counter')
+logging.info(json.dumps({'event': 'startup',
+                         'load_ms': round((perf_counter() - t_load) * 1000, 2)}))
 
-def strip_punctuations(s):
-    PUNCTUATIONS = r'[!"#$%&()*+,\-./:;<=>?@[\\\]^_`{|}~\t\n]+'
-    s = s.replace(u'\xa0', u'')
-    return re.sub("  +", " ", re.sub(PUNCTUATIONS, " ", s)).strip()
 
+def load_tokenizer():
+    with open(TOKENIZER, 'r') as fp:
+        json_str = json.load(fp)
+    return tokenizer_from_json(json_str)
 
-def get_split_index(len_arr, max_len=MAX_LEN, overlap=OVERLAP):
+
+def get_encoder():
     """
-    To split a long list into shorter ones with max_len and an overlap at front
-    Returns the index where the list should be split
+    Load the transcript encoder on first use, from the compact vocabulary
+    if it was exported with vocab.py from the current tokenizer.json, else
+    from the Keras tokenizer JSON
     """
-    if len_arr <= max_len:
-        return [[0, len_arr]]
-    else:
-        splits = [[0, max_len]]
-    i = 1
-    while True:
-        if ((max_len-overlap)*i+max_len) >= len_arr:
-            break
+    global encoder
+    if encoder is None:
+        t_start = perf_counter()
+        vocab = 'json'
+        if os.path.isdir(VOCAB):
+            vocabulary = Vocabulary(VOCAB)
+            if vocabulary.tokenizer_digest == TOKENIZER_DIGEST:
+                vocab = 'compact'
+            else:
+                logging.warning(f'{VOCAB} was not exported from the current '
+                                f'{TOKENIZER}, load it instead. Re-run vocab.py')
+        if vocab == 'compact':
+            encoder = TranscriptEncoder.from_vocabulary(vocabulary)
         else:
-            splits.append([(max_len-overlap)*i, ((max_len-overlap)*i+max_len)])
-        i += 1
-    splits.append([(max_len-overlap)*i, len_arr])
+            encoder = TranscriptEncoder.from_tokenizer(load_tokenizer())
+        logging.info(json.dumps({
+            'event': 'load_encoder',
+            'vocab': vocab,
+            'load_ms': round((perf_counter() - t_start) * 1000, 2)}))
+    return encoder
 
-    return splits
 
+def prepare_transcript(transcript, timer=None):
+    """Clean the transcript text and transform it to the model input"""
+    timer = timer or StageTimer()
+    with timer.stage('tokenize'):
+        text_segments, ids, offsets = get_encoder().encode(
+            [i.text for i in transcript.snippets])
+    with timer.stage('window'):
+        X = prepare_X(ids)
+    timer.count('windows', len(X))
+    timer.count('tokens', int(np.count_nonzero(ids >= 0)))
 
-def prepare_X(full_text_list, max_len=MAX_LEN):
-    """Split a long text list to shorter ones, transform to padded X array"""
-    split_index = get_split_index(len(full_text_list), MAX_LEN, OVERLAP)
-    splitted_text_list = [full_text_list[i[0]:i[1]] for i in split_index]
-    splitted_text = [' '.join(s) for s in splitted_text_list]
+    return text_segments, offsets, X
 
-    X = tokenizer.texts_to_sequences(splitted_text)
-    X = pad_sequences(X, maxlen=max_len, padding='post')
 
-    return X
+def run_batches(X, batch_size=BATCH_SIZE):
+    """Run inference over X in batches of at most batch_size windows"""
+    results = [model.run(None, {"embedding_3_input": X[i:i+batch_size]})[0]
+               for i in range(0, len(X), batch_size)]
 
+    return np.concatenate(results)
 
-def stitch_predictions(predictions, max_len=MAX_LEN, overlap=OVERLAP):
-    """stitch raw predictions together, discarding the end of each segment"""
-    stitched = []
-    for i in range(len(predictions)-1):
-        stitched.extend([round(p[1], 3)
-                         for p in predictions[i]][:max_len-overlap])
-    stitched.extend([round(p[1], 3) for p in predictions[-1]])
 
-    return stitched  # still has padding
+def run_model(X, batch_size=BATCH_SIZE, buckets=BUCKETS, lengths=None):
+    """
+    Run inference over X. Each window is cut to the smallest bucket length
+    that holds its first `lengths` positions (see `window_lengths`), by
+    default all its tokens. Goes through the scheduler if it's enabled
+    """
+    def infer(X):
+        if scheduler is not None:
+            return scheduler.submit(X)
+        return run_batches(X, batch_size)
+
+    if len(buckets) == 1:
+        return infer(X)
+
+    return run_buckets(X, infer, buckets, lengths)
+
 
+def assemble_transcript(transcript, text_segments, offsets, predictions):
+    """Put transcript back together with the stitched predictions"""
+    return assemble_snippets(transcript.snippets, text_segments, offsets,
+                             predictions)
 
-def get_labelled_transcript(transcript):
-    text_segments = [strip_punctuations(i.text) for i in transcript.snippets]
 
-    full_text = ' '.join(text_segments)
-    full_text_list = full_text.split(' ')
-    X = prepare_X(full_text_list).astype(np.float32)
+def assemble_snippets(snippets, text_segments, offsets, predictions):
+    """Label snippets with the predictions from word offsets[0] onwards"""
+    predictions = predictions[:offsets[-1] - offsets[0]].tolist()
 
-    results = model.run(None, {"embedding_3_input": X})
-    predictions = stitch_predictions(results[0].tolist())[:len(full_text_list)]
+    # split labels to match transcript segments
+    offsets = (offsets - offsets[0]).tolist()
+    labels = [predictions[s:e] for s, e in zip(offsets[:-1], offsets[1:])]
 
-    # Put transcript back together with labels
-    # split texts to match transcript segments.
-    # the last index is not needed since it's just the full len
-    segment_index = np.cumsum([len(t.split(' ')) for t in text_segments])[:-1]
-    start_list = [round(i.start, 2) for i in transcript.snippets]
-    end_list = [round(i.start + i.duration, 2) for i in transcript.snippets]
+    times = np.array([(i.start, i.duration) for i in snippets],
+                     dtype=np.float64).reshape(-1, 2)
+    start_list = np.round(times[:, 0], 2).tolist()
+    end_list = np.round(times[:, 0] + times[:, 1], 2).tolist()
 
-    labels = [i.tolist() for i in np.split(predictions, segment_index)]
     labelled_transcript = [
         {'text': t, 'label': l, 'start': s, 'end': e}
         for t, l, s, e in zip(text_segments, labels, start_list, end_list)
@@ -100,73 +226,365 @@ def get_labelled_transcript(transcript):
     return labelled_transcript
 
 
-def predict_video(vid):
+def label_transcript(transcript, text_segments, offsets, results):
+    """Put transcript back together with labels from raw model output"""
+    predictions = stitch_predictions(results)
+
+    return assemble_transcript(transcript, text_segments, offsets, predictions)
+
+
+def get_labelled_transcript(transcript, timer=None):
+    timer = timer or StageTimer()
+    text_segments, offsets, X = prepare_transcript(transcript, timer)
+    with timer.stage('model_run'):
+        results = run_model(X, lengths=window_lengths(offsets[-1]))
+    with timer.stage('stitch'):
+        return label_transcript(transcript, text_segments, offsets, results)
+
+
+def stream_labelled_transcript(transcript, timer=None):
+    """
+    Label a transcript window by window. After each window, yields the list
+    of snippets whose labels are final, i.e. not in the next window's overlap,
+    so only the predictions of unfinished snippets are kept
+    """
+    timer = timer or StageTimer()
+    text_segments, offsets, X = prepare_transcript(transcript, timer)
+    step = MAX_LEN - OVERLAP
+    lengths = window_lengths(offsets[-1])
+    done = 0
+    # stitched predictions from word offsets[done] onwards
+    pending = np.zeros(0)
+    for k in range(len(X)):
+        with timer.stage('model_run'):
+            probs = run_model(X[k:k+1], lengths=lengths[k:k+1])[0, :, 1]
+        with timer.stage('stitch'):
+            if k < len(X) - 1:
+                probs = probs[:step]
+                end = np.searchsorted(offsets, (k + 1) * step, 'right') - 1
+            else:
+                end = len(offsets) - 1
+            pending = np.concatenate(
+                [pending, np.round(probs.astype(np.float64), 3)])
+            labelled = assemble_snippets(
+                transcript.snippets[done:end], text_segments[done:end],
+                offsets[done:end+1], pending)
+            pending = pending[offsets[end] - offsets[done]:]
+            done = end
+        if labelled:
+            yield labelled
+
+
+def get_labelled_transcripts(transcripts, timer=None):
+    """
+    Label several transcripts at once. Windows from all transcripts are
+    packed into shared inference batches, then split back per transcript.
+    """
+    timer = timer or StageTimer()
+    prepared = [prepare_transcript(t, timer) for t in transcripts]
+    if not prepared:
+        return []
+    with timer.stage('model_run'):
+        results = run_model(
+            np.concatenate([X for _, _, X in prepared]),
+            lengths=np.concatenate([window_lengths(offsets[-1])
+                                    for _, offsets, _ in prepared]))
+
+    labelled_transcripts = []
+    start = 0
+    with timer.stage('stitch'):
+        for transcript, (text_segments, offsets, X) in zip(transcripts, prepared):
+            labelled_transcripts.append(label_transcript(
+                transcript, text_segments, offsets, results[start:start+len(X)]))
+            start += len(X)
+
+    return labelled_transcripts
+
+
+def remember_error(vid, e):
+    """Cache a fetching error in the negative cache, if it's not transient"""
+    ttl = NEGATIVE_TTLS.get(type(e).__name__)
+    if ttl:
+        negative_cache.set(vid, type(e).__name__, ttl)
+
+
+def error_response(vid, e):
+    """
+    Map a transcript fetching exception, or the name of its class from the
+    negative cache, to an error response body
+    """
+    error = e if isinstance(e, str) else type(e).__name__
+    if error == 'NoTranscriptFound':
+        status_code = 404
+        error_msg = 'Cannot fetch transcript. Only English is supported. Please try another one.'
+    elif error == 'TranscriptsDisabled':
+        status_code = 404
+        error_msg = 'Cannot fetch transcript. It\'s likely the video and/or its subtitle is disabled. Please try another one.'
+    elif error == 'TooManyRequests':
+        status_code = 429
+        error_msg = 'Too many requests.'
+    elif error == 'TimeoutError':
+        status_code = 504
+        error_msg = 'Timed out waiting for the transcript.'
+    else:
+        status_code = 404
+        error_msg = 'Cannot fetch transcript. Please try another one.'
+    logging.error(error_msg)
+    return {'statusCode': status_code,
+            'videoId': vid,
+            'version': VERSION,
+            'errorMessage': error_msg}
+
+
+def log_request(timer, **fields):
+    """Record the request metrics & write them as a structured log line"""
+    timer.observe()
+    REQUESTS.inc(label_value=fields.get('statusCode'))
+    logging.info(json.dumps({**fields, **timer.to_dict()}))
+
+
+def encode_response(response, timer, timings=False, encode=True):
+    """
+    Serialize a response body with orjson, timed as the serialize stage, and
+    return it. With timings, the stage timings, serialize included, are added
+    to it. If not encode, the caller's runtime serializes the response, e.g.
+    Lambda's, so the response is returned as is, with the timings if asked
+    """
+    if not encode:
+        if timings:
+            response['timings'] = timer.to_dict()
+        return response
+    with timer.stage('serialize'):
+        body = orjson.dumps(response)
+    if timings:
+        body = (body[:-1] + b',"timings":' +
+                orjson.dumps(timer.to_dict()) + b'}')
+    return body
+
+
+def cached_result(vid):
+    """
+    The cached labelled transcript of a video, else the class name of its
+    cached fetching error, else None
+    """
+    labelled_transcript = result_cache.get(vid)
+    if labelled_transcript is not None:
+        return labelled_transcript
+    return negative_cache.get(vid)
+
+
+def label_video(vid, timer):
+    """
+    Fetch, label & cache a video. Returns the labelled transcript, or the
+    fetching exception in its place
+    """
+    try:
+        with timer.stage('fetch'):
+            transcript = transcript_client.fetch(vid)
+    except Exception as e:
+        remember_error(vid, e)
+        return e
+
+    labelled_transcript = get_labelled_transcript(transcript, timer)
+    result_cache.set(vid, labelled_transcript)
+    return labelled_transcript
+
+
+def result_fields(labelled_transcript, segments, timer):
+    """The labelled transcript, or its sponsor segments if options are given"""
+    if segments is None:
+        return {'transcript': labelled_transcript}
+    with timer.stage('segments'):
+        return summarize(labelled_transcript, **segments)
+
+
+def predict_video(vid, timings=False, segments=None, encode=False):
+    """Label a video. Returns the response, or its JSON body if encode"""
     t_start = time()
+    timer = StageTimer()
     headers = {'Access-Control-Allow-Headers': 'Content-Type,X-Amz-Date,Authorization,X-Api-Key,X-Amz-Security-Token',
                'Access-Control-Allow-Origin': '*',
                'Access-Control-Allow-Methods': 'OPTIONS,POST,GET',
                'Content-Type': 'application/json'}
 
-    if vid is None:
-        return {'statusCode': 400,
-                'headers': headers,
-                'videoId': vid,
-                'version': VERSION,
-                'errorMessage': 'Bad request'}
-    try:
-        api = YouTubeTranscriptApi(
-            proxy_config=GenericProxyConfig(
-                http_url=os.environ.get('PROXY_HTTP_URL'),
-                https_url=os.environ.get('PROXY_HTTPS_URL'),
-            ))
-        transcript = api.fetch(
-            vid, languages=['en', 'en-US', 'en-GB'])
-    except Exception as e:
-        if type(e).__name__ == 'NoTranscriptFound':
-            error_msg = 'Cannot fetch transcript. Only English is supported. Please try another one.'
-            logging.error(error_msg)
-            return {'statusCode': 404,
+    valid = isinstance(vid, str) and bool(vid)
+    if segments is not None:
+        try:
+            segments = parse_options(segments)
+        except (TypeError, ValueError) as e:
+            logging.error(f'Bad segments options: {e}')
+            valid = False
+    if not valid:
+        response = {'statusCode': 400,
                     'headers': headers,
                     'videoId': vid,
                     'version': VERSION,
-                    'errorMessage': error_msg}
-        elif type(e).__name__ == 'TranscriptsDisabled':
-            error_msg = 'Cannot fetch transcript. It\'s likely the video and/or its subtitle is disabled. Please try another one.'
-            logging.error(error_msg)
-            return {'statusCode': 404,
-                    'headers': headers,
-                    'videoId': vid,
-                    'version': VERSION,
-                    'errorMessage': error_msg}
-        elif type(e).__name__ == 'TooManyRequests':
-            error_msg = 'Too many requests.'
-            logging.error(error_msg)
-            return {'statusCode': 429,
+                    'errorMessage': 'Bad request'}
+        body = encode_response(response, timer, encode=encode)
+        log_request(timer, event='predict', videoId=vid, statusCode=400)
+        return body
+
+    labelled_transcript = result_cache.get(vid)
+    cache_hit = labelled_transcript is not None
+    shared = False
+    if not cache_hit:
+        error = negative_cache.get(vid)
+        if error is None:
+            try:
+                # finds a result cached by a call that finished after the
+                # lookups above, instead of labelling the video again
+                result, shared = in_flight.do(
+                    vid, lambda: label_video(vid, timer), SINGLE_FLIGHT_TIMEOUT,
+                    lookup=lambda: cached_result(vid))
+            except TimeoutError as e:
+                result, shared = e, True
+            if isinstance(result, (Exception, str)):
+                error = result
+            else:
+                labelled_transcript = result
+        if error is not None:
+            response = dict(error_response(vid, error), headers=headers)
+            body = encode_response(response, timer, encode=encode)
+            log_request(timer, event='predict', videoId=vid,
+                        statusCode=response['statusCode'],
+                        negativeCacheHit=isinstance(error, str), shared=shared)
+            return body
+
+    fields = result_fields(labelled_transcript, segments, timer)
+    t_end = time()
+
+    response = {'statusCode': 200,
+                'headers': headers,
+                'videoId': vid,
+                'version': VERSION,
+                **fields,
+                'processTime': f'{(t_end - t_start):.2f}'}
+    body = encode_response(response, timer, timings, encode)
+    log_request(timer, event='predict', videoId=vid, statusCode=200,
+                cacheHit=cache_hit, shared=shared)
+    return body
+
+
+def stream_video(vid):
+    """
+    Streaming variant of predict_video. Yields lists of response lines:
+    first a header, then the labelled snippets finished by each window
+    """
+    timer = StageTimer()
+    if not isinstance(vid, str) or not vid:
+        yield [{'statusCode': 400,
+                'videoId': vid,
+                'version': VERSION,
+                'errorMessage': 'Bad request'}]
+        log_request(timer, event='predict_stream', videoId=vid, statusCode=400)
+        return
+
+    labelled_transcript = result_cache.get(vid)
+    cache_hit = labelled_transcript is not None
+    if cache_hit:
+        chunks = [labelled_transcript]
+    else:
+        error = negative_cache.get(vid)
+        if error is None:
+            try:
+                with timer.stage('fetch'):
+                    transcript = transcript_client.fetch(vid)
+            except Exception as e:
+                remember_error(vid, e)
+                error = e
+        if error is not None:
+            body = error_response(vid, error)
+            log_request(timer, event='predict_stream', videoId=vid,
+                        statusCode=body['statusCode'],
+                        negativeCacheHit=isinstance(error, str))
+            yield [body]
+            return
+        # not cached, that would need the whole labelled transcript
+        chunks = stream_labelled_transcript(transcript, timer)
+
+    yield [{'statusCode': 200, 'videoId': vid, 'version': VERSION}]
+    yield from chunks
+    log_request(timer, event='predict_stream', videoId=vid, statusCode=200,
+                cacheHit=cache_hit)
+
+
+def predict_videos(vids, timings=False, segments=None, encode=False):
+    """Label several videos, see predict_video"""
+    t_start = time()
+    timer = StageTimer()
+    headers = {'Access-Control-Allow-Headers': 'Content-Type,X-Amz-Date,Authorization,X-Api-Key,X-Amz-Security-Token',
+               'Access-Control-Allow-Origin': '*',
+               'Access-Control-Allow-Methods': 'OPTIONS,POST,GET',
+               'Content-Type': 'application/json'}
+
+    valid = (isinstance(vids, list) and 0 < len(vids) <= MAX_BATCH_VIDEOS
+             and all(isinstance(vid, str) for vid in vids))
+    if segments is not None:
+        try:
+            segments = parse_options(segments)
+        except (TypeError, ValueError) as e:
+            logging.error(f'Bad segments options: {e}')
+            valid = False
+    if not valid:
+        response = {'statusCode': 400,
                     'headers': headers,
-                    'videoId': vid,
+                    'videoIds': vids,
                     'version': VERSION,
-                    'errorMessage': error_msg}
+                    'errorMessage': 'Bad request'}
+        body = encode_response(response, timer, encode=encode)
+        log_request(timer, event='predict_batch', statusCode=400)
+        return body
+
+    results = {vid: result_cache.get(vid) for vid in dict.fromkeys(vids)}
+    errors = {vid: negative_cache.get(vid)
+              for vid, res in results.items() if res is None}
+    pending = [vid for vid, error in errors.items() if error is None]
+    with timer.stage('fetch'):
+        transcripts = dict(zip(pending, transcript_client.fetch_many(pending)))
+
+    fetched = []
+    for vid in pending:
+        if isinstance(transcripts[vid], Exception):
+            remember_error(vid, transcripts[vid])
+            errors[vid] = transcripts[vid]
         else:
-            error_msg = 'Cannot fetch transcript. Please try another one.'
-            logging.error(error_msg)
-            return {'statusCode': 404,
-                    'videoId': vid,
-                    'headers': headers,
-                    'version': VERSION,
-                    'errorMessage': error_msg}
+            fetched.append(vid)
+    labelled_transcripts = get_labelled_transcripts(
+        [transcripts[vid] for vid in fetched], timer)
+    for vid, labelled_transcript in zip(fetched, labelled_transcripts):
+        result_cache.set(vid, labelled_transcript)
+        results[vid] = labelled_transcript
 
-    labelled_transcript = get_labelled_transcript(transcript)
+    body = []
+    for vid in vids:
+        if results[vid] is None:
+            body.append(error_response(vid, errors[vid]))
+        else:
+            body.append({'statusCode': 200,
+                         'videoId': vid,
+                         'version': VERSION,
+                         **result_fields(results[vid], segments, timer)})
     t_end = time()
-    logging.info(f'Processing time {t_end - t_start:.2f} s')
 
-    return {'statusCode': 200,
-            'headers': headers,
-            'videoId': vid,
-            'version': VERSION,
-            'transcript': eval(str(labelled_transcript)),
-            'processTime': f'{(t_end - t_start):.2f}'}
+    response = {'statusCode': 200,
+                'headers': headers,
+                'version': VERSION,
+                'results': body,
+                'processTime': f'{(t_end - t_start):.2f}'}
+    body = encode_response(response, timer, timings, encode)
+    log_request(timer, event='predict_batch', videos=len(vids), statusCode=200,
+                cacheHits=len(results) - len(errors),
+                negativeCacheHits=len(errors) - len(pending))
+    return body
 
 
 def lambda_handler(event, context):
     vid = event.get("vid")
-    return predict_video(vid)
+    return predict_video(vid, timings=bool(event.get("timings")),
+                         segments=event.get("segments"))
+
+
+def batch_lambda_handler(event, context):
+    vids = event.get("vids")
+    return predict_videos(vids, timings=bool(event.get("timings")),
+                          segments=event.get("segments"))
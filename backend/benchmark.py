@@ -0,0 +1,450 @@
+"""
+Offline benchmarks for the prediction pipeline. Run them in the backend
+directory, next to the packaged model, e.g.:
+
+    python benchmark.py stages --output stages.json
+    python benchmark.py tokenize --hours 3 10
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import random
+import re
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from time import perf_counter, sleep
+from types import SimpleNamespace
+
+import numpy as np
+import onnxruntime as ort
+import orjson
+import requests
+
+import app
+from segments import summarize
+from transcript import TranscriptClient
+from utils import pad_sequences
+from windows import get_split_index
+
+tokenizer = app.load_tokenizer()
+
+WORDS_PER_SECOND = 2.5  # ~150 words per minute of speech
+PUNCTUATIONS = ['', '', '', ',', '.', '?', '!', ' -', '...']
+
+
+def make_transcript(hours, seed=0, gaps=False):
+    """
+    Generate a synthetic transcript shaped like `FetchedTranscript`. With gaps,
+    some snippets contain only punctuation and normalize to an empty string
+    """
+    rng = random.Random(seed)
+    # includes words beyond num_words, which are mapped to the OOV token
+    vocab = [w for w in tokenizer.word_index if w != tokenizer.oov_token]
+    vocab = vocab[:20000]
+    snippets = []
+    t = 0.0
+    while t < hours * 3600:
+        n_words = rng.randint(1, 14)
+        words = [rng.choice(vocab).capitalize() if rng.random() < 0.1
+                 else rng.choice(vocab) for _ in range(n_words)]
+        text = ' '.join(w + rng.choice(PUNCTUATIONS) for w in words)
+        if gaps and rng.random() < 0.02:
+            text = '...'
+        duration = n_words / WORDS_PER_SECOND
+        snippets.append(SimpleNamespace(text=text, start=t, duration=duration))
+        t += duration
+    return SimpleNamespace(snippets=snippets)
+
+
+def best_of(fn, repeat=5):
+    """Return the result and the best wall time of several runs of fn"""
+    times = []
+    for _ in range(repeat):
+        t_start = perf_counter()
+        result = fn()
+        times.append(perf_counter() - t_start)
+    return result, min(times)
+
+
+def legacy_strip_punctuations(s):
+    PUNCTUATIONS = r'[!"#$%&()*+,\-./:;<=>?@[\\\]^_`{|}~\t\n]+'
+    s = s.replace(u'\xa0', u'')
+    return re.sub("  +", " ", re.sub(PUNCTUATIONS, " ", s)).strip()
+
+
+def legacy_tokenize(texts):
+    """Normalize & tokenize snippets window by window, as prepare_X used to"""
+    text_segments = [legacy_strip_punctuations(t) for t in texts]
+    full_text_list = ' '.join(text_segments).split(' ')
+    split_index = get_split_index(len(full_text_list))
+    splitted_text = [' '.join(full_text_list[i[0]:i[1]]) for i in split_index]
+    return tokenizer.texts_to_sequences(splitted_text)
+
+
+def fused_tokenize(texts):
+    _, ids, _ = app.get_encoder().encode(texts)
+    return [ids[i[0]:i[1]][ids[i[0]:i[1]] >= 0]
+            for i in get_split_index(len(ids))]
+
+
+def legacy_prepare_X(texts):
+    X = pad_sequences(legacy_tokenize(texts), maxlen=app.MAX_LEN, padding='post')
+    return X.astype(np.float32)
+
+
+def strided_prepare_X(texts):
+    _, ids, _ = app.get_encoder().encode(texts)
+    return app.prepare_X(ids)
+
+
+def bench_windows(hours_list):
+    print(f'{"hours":>6} {"gaps":>5} {"windows":>8} {"legacy ms":>10} '
+          f'{"strided ms":>11} {"speedup":>8}')
+    for hours in hours_list:
+        for gaps in [False, True]:
+            texts = [s.text for s in make_transcript(hours, gaps=gaps).snippets]
+            legacy, t_legacy = best_of(lambda: legacy_prepare_X(texts))
+            strided, t_strided = best_of(lambda: strided_prepare_X(texts))
+            # the model input must be bit-identical
+            assert legacy.dtype == strided.dtype
+            assert np.array_equal(legacy, strided)
+
+            print(f'{hours:>6} {str(gaps):>5} {len(strided):>8} '
+                  f'{t_legacy * 1000:>10.1f} {t_strided * 1000:>11.1f} '
+                  f'{t_legacy / t_strided:>7.1f}x')
+
+
+def legacy_stitch_predictions(predictions, max_len=app.MAX_LEN,
+                              overlap=app.OVERLAP):
+    stitched = []
+    for i in range(len(predictions)-1):
+        stitched.extend([round(p[1], 3)
+                         for p in predictions[i]][:max_len-overlap])
+    stitched.extend([round(p[1], 3) for p in predictions[-1]])
+    return stitched
+
+
+def legacy_postprocess(transcript, text_segments, offsets, results):
+    """Stitch, label & serialize as predict_video used to"""
+    predictions = legacy_stitch_predictions(results.tolist())[:offsets[-1]]
+    start_list = [round(i.start, 2) for i in transcript.snippets]
+    end_list = [round(i.start + i.duration, 2) for i in transcript.snippets]
+    labels = [i.tolist() for i in np.split(predictions, offsets[1:-1])]
+    labelled_transcript = [
+        {'text': t, 'label': l, 'start': s, 'end': e}
+        for t, l, s, e in zip(text_segments, labels, start_list, end_list)
+    ]
+    return json.dumps({'transcript': eval(str(labelled_transcript))})
+
+
+def vectorized_postprocess(transcript, text_segments, offsets, results):
+    labelled_transcript = app.label_transcript(
+        transcript, text_segments, offsets, results)
+    return orjson.dumps({'transcript': labelled_transcript})
+
+
+def fake_results(X, seed=0):
+    """Random softmax-like model output, so no inference is needed"""
+    p = np.random.default_rng(seed).random(X.shape, dtype=np.float32)
+    return np.stack([1 - p, p], axis=-1)
+
+
+def bench_postprocess(hours_list):
+    print(f'{"hours":>6} {"windows":>8} {"legacy ms":>10} '
+          f'{"vectorized ms":>14} {"speedup":>8}')
+    for hours in hours_list:
+        transcript = make_transcript(hours)
+        text_segments, offsets, X = app.prepare_transcript(transcript)
+        results = fake_results(X)
+        args = (transcript, text_segments, offsets, results)
+
+        legacy, t_legacy = best_of(lambda: legacy_postprocess(*args))
+        fast, t_fast = best_of(lambda: vectorized_postprocess(*args))
+        assert json.loads(legacy) == orjson.loads(fast)
+
+        print(f'{hours:>6} {len(X):>8} {t_legacy * 1000:>10.1f} '
+              f'{t_fast * 1000:>14.1f} {t_legacy / t_fast:>7.1f}x')
+
+
+def sponsored_results(X, seed=0, n_sponsors=3, length=150):
+    """Model output with low probabilities, except for a few sponsor reads"""
+    rng = np.random.default_rng(seed)
+    p = rng.random(X.shape, dtype=np.float32) * 0.2
+    for start in rng.integers(0, p.size - length, n_sponsors):
+        p.flat[start:start+length] = 0.8 + 0.2 * rng.random(length)
+    return np.stack([1 - p, p], axis=-1)
+
+
+def bench_payload(hours_list):
+    """Size & build time of the full transcript vs the segments response"""
+    print(f'{"hours":>6} {"format":>10} {"KiB":>9} {"ms":>8} '
+          f'{"size":>7} {"time":>7}')
+    for hours in hours_list:
+        transcript = make_transcript(hours)
+        text_segments, offsets, X = app.prepare_transcript(transcript)
+        labelled_transcript = app.label_transcript(
+            transcript, text_segments, offsets, sponsored_results(X))
+
+        formats = {
+            'transcript': lambda: orjson.dumps(
+                {'transcript': labelled_transcript}),
+            'segments': lambda: orjson.dumps(summarize(labelled_transcript)),
+            '+track': lambda: orjson.dumps(
+                summarize(labelled_transcript, track=True)),
+        }
+        baseline = None
+        for name, fn in formats.items():
+            body, t = best_of(fn)
+            baseline = baseline or (len(body), t)
+            print(f'{hours:>6} {name:>10} {len(body) / 2 ** 10:>9.1f} '
+                  f'{t * 1000:>8.2f} {baseline[0] / len(body):>6.0f}x '
+                  f'{baseline[1] / t:>6.1f}x')
+
+
+def bench_buckets(buckets, repeat):
+    """Latency vs length of a single window, and fixed vs bucketed parity"""
+    buckets = tuple(sorted(set(buckets) | {app.MAX_LEN}))
+    if isinstance(app.model.get_inputs()[0].shape[1], int):
+        raise SystemExit('Bucketed inference needs a model with a dynamic '
+                         'time axis, see training/exporter.py')
+
+    print(f'{"words":>6} {"bucket":>7} {"fixed ms":>9} {"bucketed ms":>12} '
+          f'{"speedup":>8} {"max abs diff":>13}')
+    for n_words in [100, 300, 500, 1000, 2000, 3000]:
+        transcript = make_transcript(n_words / WORDS_PER_SECOND / 3600)
+        _, offsets, X = app.prepare_transcript(transcript)
+        X = X[:1]
+        n_tokens = np.count_nonzero(X)
+        fixed, t_fixed = best_of(
+            lambda: app.run_model(X, buckets=(app.MAX_LEN,)), repeat)
+        bucketed, t_bucketed = best_of(
+            lambda: app.run_model(X, buckets=buckets), repeat)
+        diff = np.abs(fixed[0, :n_tokens] - bucketed[0, :n_tokens]).max()
+        assert diff < 1e-4, 'bucketed predictions differ from fixed length'
+
+        bucket = buckets[np.searchsorted(buckets, n_tokens)]
+        print(f'{n_tokens:>6} {bucket:>7} {t_fixed * 1000:>9.1f} '
+              f'{t_bucketed * 1000:>12.1f} {t_fixed / t_bucketed:>7.1f}x '
+              f'{diff:>13.2e}')
+
+
+def time_stages(transcript, repeat):
+    """Time each stage of get_labelled_transcript and the serialization"""
+    texts = [s.text for s in transcript.snippets]
+    stages = {}
+
+    def run(name, fn):
+        result, stages[name] = best_of(fn, repeat)
+        return result
+
+    encoder = app.get_encoder()
+    text_segments = run('normalize', lambda: encoder.normalize(texts))
+    ids, offsets = run('tokenize', lambda: encoder.tokenize(text_segments))
+    X = run('prepare_X', lambda: app.prepare_X(ids))
+    results = run('model_run', lambda: app.run_model(X))
+    predictions = run('stitch', lambda: app.stitch_predictions(results))
+    labelled_transcript = run('assemble', lambda: app.assemble_transcript(
+        transcript, text_segments, offsets, predictions))
+    run('serialize', lambda: orjson.dumps({'transcript': labelled_transcript}))
+
+    return {'snippets': len(texts),
+            'words': int(offsets[-1]),
+            'tokens': int(np.count_nonzero(X)),
+            'windows': len(X),
+            'stages_ms': {k: v * 1000 for k, v in stages.items()}}
+
+
+def bench_stages(hours_list, repeat, output):
+    report = {'timestamp': datetime.now(timezone.utc).isoformat(),
+              'version': app.VERSION,
+              'model': app.result_cache.namespace,
+              'buckets': app.BUCKETS,
+              'batch_size': app.BATCH_SIZE,
+              'python': platform.python_version(),
+              'numpy': np.__version__,
+              'onnxruntime': ort.__version__,
+              'machine': platform.machine(),
+              'results': []}
+
+    print(f'{"hours":>6} {"windows":>8} ' + ' '.join(
+        f'{s:>10}' for s in ['normalize', 'tokenize', 'prepare_X',
+                             'model_run', 'stitch', 'assemble', 'serialize']))
+    for hours in hours_list:
+        result = dict(hours=hours, **time_stages(make_transcript(hours), repeat))
+        report['results'].append(result)
+        print(f'{hours:>6} {result["windows"]:>8} ' + ' '.join(
+            f'{t:>10.2f}' for t in result['stages_ms'].values()))
+
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f'Results dumped to {output}')
+
+
+def bench_tokenize(hours_list):
+    print(f'{"hours":>6} {"words":>8} {"legacy ms":>10} {"fused ms":>10} {"speedup":>8}')
+    for hours in hours_list:
+        texts = [s.text for s in make_transcript(hours).snippets]
+        legacy, t_legacy = best_of(lambda: legacy_tokenize(texts))
+        fused, t_fused = best_of(lambda: fused_tokenize(texts))
+        assert len(legacy) == len(fused)
+        assert all(np.array_equal(a, b) for a, b in zip(legacy, fused))
+
+        n_words = sum(len(x) for x in legacy)
+        print(f'{hours:>6} {n_words:>8} {t_legacy * 1000:>10.1f} '
+              f'{t_fused * 1000:>10.1f} {t_legacy / t_fused:>7.1f}x')
+
+
+class StandInApi(object):
+    """Return a synthetic transcript after a simulated fetch latency"""
+
+    def __init__(self, transcript, latency):
+        self.transcript = transcript
+        self.latency = latency
+
+    def fetch(self, vid, languages):
+        sleep(self.latency)
+        return self.transcript
+
+
+def start_server(mode, port, hours, fetch_ms):
+    """Serve transcripts from StandInApi, runs in a spawned process"""
+    import serve
+    # keep the server logs out of the results table
+    sys.stdout = sys.stderr = open(os.devnull, 'w')
+    transcript = make_transcript(hours)
+    app.transcript_client = TranscriptClient(
+        api_factory=lambda session: StandInApi(transcript, fetch_ms / 1000))
+    serve.serve(mode, port=port)
+
+
+def wait_until_ready(url, process, timeout=60):
+    t_start = perf_counter()
+    while perf_counter() - t_start < timeout:
+        if not process.is_alive():
+            raise SystemExit('Server exited during startup')
+        try:
+            requests.get(f'{url}/stats', timeout=1).raise_for_status()
+            return
+        except requests.RequestException:
+            sleep(0.2)
+    raise SystemExit(f'Server not ready after {timeout} seconds')
+
+
+def load_test(url, prefix, concurrency, n_requests):
+    """Post n_requests unique (uncached) videos, concurrency at a time"""
+    def call(i):
+        t_start = perf_counter()
+        r = requests.post(f'{url}/predict', json={'vid': f'{prefix}-{i}'})
+        r.raise_for_status()
+        assert r.json()['statusCode'] == 200
+        return perf_counter() - t_start
+
+    t_start = perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        latencies = np.array(list(executor.map(call, range(n_requests))))
+    return n_requests / (perf_counter() - t_start), latencies
+
+
+def bench_throughput(servers, concurrencies, n_requests, hours, fetch_ms, port):
+    """
+    Throughput & latency of server configurations, e.g. "dev" or
+    "gunicorn:4x1" for 4 worker processes of 1 thread each
+    """
+    url = f'http://127.0.0.1:{port}'
+    print(f'{"server":>14} {"concurrency":>12} {"req/s":>8} '
+          f'{"p50 ms":>8} {"p99 ms":>8}')
+    for server in servers:
+        mode, _, size = server.partition(':')
+        workers, _, threads = size.partition('x')
+        # read by app & serve in the spawned server process
+        os.environ['WORKERS'] = workers or '1'
+        os.environ['THREADS'] = threads or '1'
+        process = multiprocessing.get_context('spawn').Process(
+            target=start_server, args=(mode, port, hours, fetch_ms))
+        process.start()
+        try:
+            wait_until_ready(url, process)
+            for concurrency in concurrencies:
+                rate, latencies = load_test(url, f'{server}-{concurrency}',
+                                            concurrency, n_requests)
+                print(f'{server:>14} {concurrency:>12} {rate:>8.1f} '
+                      f'{np.percentile(latencies, 50) * 1000:>8.1f} '
+                      f'{np.percentile(latencies, 99) * 1000:>8.1f}')
+        finally:
+            process.terminate()
+            process.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    stages = subparsers.add_parser(
+        'stages', help='time every pipeline stage, dump results to JSON')
+    stages.add_argument('--hours', type=float, nargs='+',
+                        default=[0.05, 0.25, 1, 3, 10])
+    stages.add_argument('--repeat', type=int, default=3)
+    stages.add_argument('--output', default='benchmark.json')
+
+    tokenize = subparsers.add_parser(
+        'tokenize', help='legacy vs fused normalizer & tokenizer')
+    tokenize.add_argument('--hours', type=float, nargs='+', default=[3, 6, 10])
+
+    windows = subparsers.add_parser(
+        'windows', help='legacy vs strided model input, checks parity')
+    windows.add_argument('--hours', type=float, nargs='+',
+                         default=[0.05, 0.5, 3, 10])
+
+    postprocess = subparsers.add_parser(
+        'postprocess', help='legacy vs vectorized stitching & serialization')
+    postprocess.add_argument('--hours', type=float, nargs='+',
+                             default=[0.05, 0.5, 3, 10])
+
+    buckets = subparsers.add_parser(
+        'buckets', help='latency vs length of fixed vs bucketed inference')
+    buckets.add_argument('--buckets', type=int, nargs='+',
+                         default=[512, 1024, 2048, 3000])
+    buckets.add_argument('--repeat', type=int, default=5)
+
+    payload = subparsers.add_parser(
+        'payload', help='full transcript vs segments response size & time')
+    payload.add_argument('--hours', type=float, nargs='+',
+                         default=[0.25, 1, 3, 10])
+
+    throughput = subparsers.add_parser(
+        'throughput', help='requests/s of server modes under concurrent load')
+    throughput.add_argument('--servers', nargs='+',
+                            default=['dev', 'gunicorn:1x8', 'gunicorn:4x1'],
+                            help='dev or gunicorn:<workers>x<threads>')
+    throughput.add_argument('--concurrency', type=int, nargs='+',
+                            default=[1, 4, 16])
+    throughput.add_argument('--requests', type=int, default=64)
+    throughput.add_argument('--hours', type=float, default=0.25,
+                            help='length of the served transcript')
+    throughput.add_argument('--fetch-ms', type=float, default=200,
+                            help='simulated transcript fetch latency')
+    throughput.add_argument('--port', type=int, default=8090)
+
+    args = parser.parse_args()
+    if args.benchmark == 'stages':
+        bench_stages(args.hours, args.repeat, args.output)
+    elif args.benchmark == 'tokenize':
+        bench_tokenize(args.hours)
+    elif args.benchmark == 'windows':
+        bench_windows(args.hours)
+    elif args.benchmark == 'postprocess':
+        bench_postprocess(args.hours)
+    elif args.benchmark == 'buckets':
+        bench_buckets(args.buckets, args.repeat)
+    elif args.benchmark == 'payload':
+        bench_payload(args.hours)
+    elif args.benchmark == 'throughput':
+        bench_throughput(args.servers, args.concurrency, args.requests,
+                         args.hours, args.fetch_ms, args.port)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+from time import time
+
+
+def file_digest(*paths):
+    """Return a short content hash over one or more files"""
+    h = hashlib.sha256()
+    for path in paths:
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+    return h.hexdigest()[:16]
+
+
+class ResultCache(object):
+    """Two-tier cache with an in-process LRU and an optional SQLite store.
+
+    Entries are scoped by `namespace`, so results produced by another
+    version of the code or model are never returned. Rows from other
+    namespaces are purged from the SQLite store when it is opened.
+
+    A SQLite connection must not be used across fork(), so each process
+    opens its own on first use, e.g. every worker forked by a preloading
+    server. They all share the file.
+
+    # Arguments
+        namespace: string identifying the producer of the cached values.
+        max_size: maximum number of entries kept in memory.
+        ttl: default time to live of an entry, in seconds.
+        path: SQLite file for the persistent tier. Memory only if None.
+        table: SQLite table name, so several caches can share one file.
+    """
+
+    def __init__(self, namespace, max_size=256, ttl=86400, path=None,
+                 table='results'):
+        self.namespace = namespace
+        self.max_size = max_size
+        self.ttl = ttl
+        self.path = path
+        self.table = table
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        # connection of the process with id _pid
+        self._db = None
+        self._pid = None
+        self._inherited = None
+        if path:
+            db = self._connect()
+            with db:
+                db.execute(
+                    f'CREATE TABLE IF NOT EXISTS {table} '
+                    '(key TEXT PRIMARY KEY, namespace TEXT, '
+                    'value TEXT, expires REAL)')
+                db.execute(
+                    f'DELETE FROM {table} WHERE namespace != ? OR expires < ?',
+                    (namespace, time()))
+            # not kept open, processes forked from this one would inherit it
+            db.close()
+            self._db = None
+
+    def _connect(self):
+        """The SQLite connection of this process, opened on first use"""
+        if self._db is None or self._pid != os.getpid():
+            # one inherited from the parent is never used nor closed: closing
+            # it would drop the POSIX locks this process holds on the file
+            self._inherited = self._db
+            self._db = sqlite3.connect(self.path, timeout=5,
+                                       check_same_thread=False)
+            self._pid = os.getpid()
+        return self._db
+
+    def get(self, key):
+        """Return the cached value for key, or None"""
+        now = time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[1] > now:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[0]
+                del self._entries[key]
+
+            if self.path:
+                row = self._connect().execute(
+                    f'SELECT value, expires FROM {self.table} '
+                    'WHERE key = ? AND namespace = ?',
+                    (key, self.namespace)).fetchone()
+                if row is not None and row[1] > now:
+                    value = json.loads(row[0])
+                    self._remember(key, value, row[1])
+                    self.hits += 1
+                    return value
+
+            self.misses += 1
+            return None
+
+    def set(self, key, value, ttl=None):
+        """Store a JSON serializable value under key"""
+        expires = time() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._remember(key, value, expires)
+            if self.path:
+                db = self._connect()
+                with db:
+                    db.execute(
+                        f'INSERT OR REPLACE INTO {self.table} '
+                        'VALUES (?, ?, ?, ?)',
+                        (key, self.namespace, json.dumps(value), expires))
+
+    def _remember(self, key, value, expires):
+        self._entries[key] = (value, expires)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def stats(self):
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'size': len(self._entries)}
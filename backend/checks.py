@@ -0,0 +1,167 @@
+"""
+Parity checks of the prediction pipeline against the implementations it
+replaced. They need neither the model nor the tokenizer, so they can run
+anywhere the requirements are installed:
+
+    python checks.py
+
+Exits with a non-zero status if any check fails.
+"""
+import sys
+import threading
+
+import numpy as np
+
+from cache import ResultCache
+from segments import MAX_SMOOTHING, parse_options, summarize
+from singleflight import SingleFlight
+from utils import pad_sequences
+from windows import (MAX_LEN, get_split_index, prepare_X, run_buckets,
+                     stitch_predictions, window_lengths)
+
+BUCKETS = (512, 1024, 2048, MAX_LEN)
+# around the window & overlap boundaries
+LENGTHS = [0, 1, 2, 2199, 2200, 2999, 3000, 3001, 5200, 5201, 7400, 7401,
+           20000]
+
+
+class CheckFailed(Exception):
+    pass
+
+
+def padded_prepare_X(ids, max_len=MAX_LEN):
+    """Windows as prepare_X built them with pad_sequences, words without a
+    token dropped by the tokenizer"""
+    windows = [ids[start:end][ids[start:end] >= 0]
+               for start, end in get_split_index(len(ids))]
+    X = pad_sequences(windows, maxlen=max_len, padding='post')
+    return X.astype(np.float32)
+
+
+def check_windows(lengths=LENGTHS, oov_rate=0.05, seed=0):
+    """prepare_X matches the pad_sequences path, with & without OOV words"""
+    rng = np.random.default_rng(seed)
+    for length in lengths:
+        for rate in [0, oov_rate, 1]:
+            ids = rng.integers(1, 10000, length).astype(np.int32)
+            ids[rng.random(length) < rate] = -1
+            expected, X = padded_prepare_X(ids), prepare_X(ids)
+            if X.dtype != expected.dtype or not np.array_equal(X, expected):
+                raise CheckFailed(f'prepare_X differs from pad_sequences '
+                                  f'for {length} words, {rate:.0%} OOV')
+
+
+def masked_model(X):
+    """
+    Stand-in for the model: like a masked LSTM, the output of a padding
+    position carries that of the last token, so it depends on the tokens
+    only, not on the sequence length
+    """
+    p = np.cumsum(X, axis=1) / (1 + np.cumsum(X > 0, axis=1)) / 10000
+    return np.stack([1 - p, p], axis=-1).astype(np.float32)
+
+
+def check_buckets(lengths=LENGTHS, oov_rate=0.3, seed=0):
+    """Bucketed inference labels every word as the fixed length one, also
+    when words without a token leave windows ending in padding"""
+    rng = np.random.default_rng(seed)
+    for length in lengths:
+        ids = rng.integers(1, 10000, length).astype(np.int32)
+        ids[rng.random(length) < oov_rate] = -1
+        X = prepare_X(ids)
+        fixed = stitch_predictions(masked_model(X))[:length]
+        bucketed = stitch_predictions(run_buckets(
+            X, masked_model, BUCKETS, window_lengths(length)))[:length]
+        if not np.array_equal(fixed, bucketed):
+            raise CheckFailed(f'bucketed labels differ from fixed length '
+                              f'ones for {length} words')
+
+
+def check_short_transcripts():
+    """Segments of transcripts shorter than the smoothing window"""
+    for n_words in range(5):
+        labelled_transcript = [{'text': ' '.join(['word'] * n_words),
+                                'label': [0.9] * n_words,
+                                'start': 0.0, 'end': 2.0}]
+        for smoothing in [1, 2, 10, MAX_SMOOTHING]:
+            body = summarize(labelled_transcript, smoothing=smoothing,
+                             track=True)
+            expected = [[0.0, 2.0, 0.9]] if n_words else []
+            if body['segments'] != expected:
+                raise CheckFailed(f'{n_words} words, smoothing {smoothing}: '
+                                  f'{body["segments"]}')
+
+
+def check_segments_options():
+    """Non integer or out of range smoothing and non boolean track are
+    rejected"""
+    valid = [({'smoothing': MAX_SMOOTHING}, 'smoothing', MAX_SMOOTHING),
+             ({'smoothing': '5'}, 'smoothing', 5),
+             ({'track': 'false'}, 'track', False),
+             ({'track': '0'}, 'track', False),
+             ({'track': 1}, 'track', True),
+             ({'track': 'true'}, 'track', True)]
+    for options, name, value in valid:
+        if parse_options(options)[name] != value:
+            raise CheckFailed(f'{options} parsed as {parse_options(options)}')
+    for options in [{'smoothing': MAX_SMOOTHING + 1}, {'smoothing': 0},
+                    {'smoothing': 1.5}, {'smoothing': True},
+                    {'smoothing': '1.5'},
+                    {'track': 'no'}, {'track': 2}, {'track': None}]:
+        try:
+            parse_options(options)
+        except ValueError:
+            continue
+        raise CheckFailed(f'{options} accepted')
+
+
+def check_single_flight(timeout=5):
+    """A caller that misses the cache while the first call runs, and only
+    enters the flight once it is done, reads the cached result"""
+    cache, in_flight = ResultCache('check'), SingleFlight()
+    calls = []
+    running, missed = threading.Event(), threading.Event()
+
+    def label():
+        calls.append('vid')
+        running.set()
+        missed.wait(timeout)
+        cache.set('vid', ['labelled'])
+        return ['labelled']
+
+    def lookup():
+        return cache.get('vid')
+
+    first = threading.Thread(target=in_flight.do,
+                             args=('vid', label, timeout, lookup))
+    first.start()
+    running.wait(timeout)
+    # the late caller misses the cache before the first call stores its result
+    late_miss = lookup() is None
+    missed.set()
+    first.join(timeout)
+    result, _ = in_flight.do('vid', label, timeout, lookup)
+    if not late_miss or len(calls) != 1 or result != ['labelled']:
+        raise CheckFailed(f'the video was labelled {len(calls)} times')
+
+
+CHECKS = [check_windows, check_buckets, check_short_transcripts,
+          check_segments_options, check_single_flight]
+
+
+def main():
+    failed = 0
+    for check in CHECKS:
+        try:
+            check()
+        except Exception as e:
+            # a crash fails the check as well
+            failed += 1
+            print(f'FAIL {check.__name__}: {type(e).__name__}: {e}')
+        else:
+            print(f'ok   {check.__name__}')
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
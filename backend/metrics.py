@@ -0,0 +1,154 @@
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+from time import perf_counter
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1, 2.5, 5, 10, 30, 60)
+
+REGISTRY = []
+
+
+def _labels(label, value, **extra):
+    pairs = ([(label, value)] if label else []) + list(extra.items())
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{k}="{v}"' for k, v in pairs) + '}'
+
+
+class Counter(object):
+    """Monotonic counter, optionally split by the values of one label"""
+
+    def __init__(self, name, documentation, label=None):
+        self.name = name
+        self.documentation = documentation
+        self.label = label
+        self._values = defaultdict(float)
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def inc(self, amount=1, label_value=None):
+        with self._lock:
+            self._values[label_value] += amount
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}',
+                 f'# TYPE {self.name} counter']
+        with self._lock:
+            for value, count in self._values.items():
+                lines.append(f'{self.name}{_labels(self.label, value)} {count}')
+        return lines
+
+
+class Gauge(object):
+    """
+    Value read from a callback when rendered, e.g. from counters kept by
+    another object, in which case metric_type is counter
+    """
+
+    def __init__(self, name, documentation, fn, metric_type='gauge'):
+        self.name = name
+        self.documentation = documentation
+        self.fn = fn
+        self.metric_type = metric_type
+        REGISTRY.append(self)
+
+    def render(self):
+        return [f'# HELP {self.name} {self.documentation}',
+                f'# TYPE {self.name} {self.metric_type}',
+                f'{self.name} {self.fn()}']
+
+
+class Histogram(object):
+    """Cumulative histogram, optionally split by the values of one label"""
+
+    def __init__(self, name, documentation, label=None,
+                 buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.label = label
+        self.buckets = tuple(buckets) + (float('inf'),)
+        self._counts = {}
+        self._sums = defaultdict(float)
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def observe(self, amount, label_value=None):
+        with self._lock:
+            counts = self._counts.setdefault(label_value,
+                                             [0] * len(self.buckets))
+            for i, bound in enumerate(self.buckets):
+                if amount <= bound:
+                    counts[i] += 1
+            self._sums[label_value] += amount
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}',
+                 f'# TYPE {self.name} histogram']
+        with self._lock:
+            for value, counts in self._counts.items():
+                for bound, count in zip(self.buckets, counts):
+                    le = '+Inf' if bound == float('inf') else bound
+                    lines.append(f'{self.name}_bucket'
+                                 f'{_labels(self.label, value, le=le)} {count}')
+                lines.append(f'{self.name}_sum{_labels(self.label, value)} '
+                             f'{self._sums[value]}')
+                lines.append(f'{self.name}_count{_labels(self.label, value)} '
+                             f'{counts[-1]}')
+        return lines
+
+
+def render():
+    """Render all metrics in the Prometheus text format"""
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+STAGE_SECONDS = Histogram('sponsor_stage_seconds',
+                          'Time spent in each stage of a prediction',
+                          label='stage')
+REQUEST_SECONDS = Histogram('sponsor_request_seconds',
+                            'Total time of a prediction request')
+WINDOWS = Histogram('sponsor_request_windows',
+                    'Number of model input windows per prediction',
+                    buckets=(1, 2, 4, 8, 16, 32, 64, 128))
+TOKENS = Counter('sponsor_tokens_total', 'Number of tokens run through the model')
+REQUESTS = Counter('sponsor_requests_total',
+                   'Number of predictions by status code', label='status')
+
+
+class StageTimer(object):
+    """Record the wall time of named stages and counts of one request"""
+
+    def __init__(self):
+        self.stages = defaultdict(float)
+        self.counts = defaultdict(int)
+        self.t_start = perf_counter()
+
+    @contextmanager
+    def stage(self, name):
+        t_start = perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] += perf_counter() - t_start
+
+    def count(self, name, amount):
+        self.counts[name] += amount
+
+    def observe(self):
+        """Add the recorded stages to the shared histograms"""
+        REQUEST_SECONDS.observe(perf_counter() - self.t_start)
+        for name, seconds in self.stages.items():
+            STAGE_SECONDS.observe(seconds, name)
+        if 'windows' in self.counts:
+            WINDOWS.observe(self.counts['windows'])
+        TOKENS.inc(self.counts.get('tokens', 0))
+
+    def to_dict(self):
+        return {'total_ms': round((perf_counter() - self.t_start) * 1000, 2),
+                'stages_ms': {k: round(v * 1000, 2)
+                              for k, v in self.stages.items()},
+                **self.counts}
@@ -0,0 +1,93 @@
+import os
+import queue
+import threading
+from collections import defaultdict
+from concurrent.futures import Future
+from time import perf_counter
+
+import numpy as np
+from metrics import Histogram
+
+BATCH_FILL = Histogram('sponsor_scheduler_batch_fill',
+                       'Windows per coalesced model run, over the max batch',
+                       buckets=(0.1, 0.25, 0.5, 0.75, 0.9, 1))
+QUEUE_SECONDS = Histogram('sponsor_scheduler_queue_seconds',
+                          'Time windows wait in the scheduler queue',
+                          buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+                                   0.05, 0.1, 0.25, 0.5, 1))
+
+
+class InferenceScheduler(object):
+    """Coalesce the model inputs of concurrent requests into shared runs.
+
+    Requests block in `submit` while a worker thread collects the queued
+    windows, until it holds `max_batch` windows or the oldest has waited
+    `max_wait` seconds. It then runs the windows of the same length as one
+    batch and hands every request back its own rows.
+
+    # Arguments
+        run_fn: callable running the model on an array of windows.
+        max_batch: number of windows that triggers a flush.
+        max_wait: maximum time in seconds a window waits for others.
+    """
+
+    def __init__(self, run_fn, max_batch=16, max_wait=0.005):
+        self.run_fn = run_fn
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def _ensure_worker(self):
+        # a worker started before a fork does not exist in the child
+        with self._lock:
+            if self._pid != os.getpid():
+                self._queue = queue.Queue()
+                threading.Thread(target=self._loop, name='inference',
+                                 daemon=True).start()
+                self._pid = os.getpid()
+
+    def submit(self, X):
+        """Queue windows X, block until their model output is ready"""
+        self._ensure_worker()
+        future = Future()
+        self._queue.put((X, future, perf_counter()))
+        return future.result()
+
+    def _loop(self):
+        while True:
+            first = self._queue.get()
+            pending = [first]
+            n_windows = len(first[0])
+            deadline = first[2] + self.max_wait
+            while n_windows < self.max_batch:
+                timeout = deadline - perf_counter()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                pending.append(item)
+                n_windows += len(item[0])
+            self._flush(pending)
+
+    def _flush(self, pending):
+        t_flush = perf_counter()
+        groups = defaultdict(list)
+        for X, future, t_queued in pending:
+            QUEUE_SECONDS.observe(t_flush - t_queued)
+            groups[X.shape[1:]].append((X, future))
+
+        for items in groups.values():
+            sizes = [len(X) for X, _ in items]
+            BATCH_FILL.observe(min(sum(sizes) / self.max_batch, 1))
+            try:
+                results = self.run_fn(np.concatenate([X for X, _ in items]))
+            except Exception as e:
+                for _, future in items:
+                    future.set_exception(e)
+                continue
+            for (_, future), result in zip(
+                    items, np.split(results, np.cumsum(sizes)[:-1])):
+                future.set_result(result)
@@ -0,0 +1,136 @@
+"""
+Compact response format: the sponsor time ranges of a labelled transcript,
+instead of a probability for every word. Optionally with the probabilities
+as a quantized track of one byte per word.
+"""
+import base64
+from itertools import chain
+
+import numpy as np
+from windows import MAX_LEN
+
+THRESHOLD = 0.5
+SMOOTHING = 1  # words in the moving average, 1 disables it
+MAX_SMOOTHING = MAX_LEN
+MIN_DURATION = 0.0  # seconds
+
+
+def parse_bool(value, name):
+    """A JSON or query string boolean: true/false or 1/0"""
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, (int, str)) and str(value).lower() in ('1', 'true'):
+        return True
+    if isinstance(value, (int, str)) and str(value).lower() in ('0', 'false'):
+        return False
+    raise ValueError(f'{name} must be true or false')
+
+
+def parse_int(value, name):
+    """An integer, or a string of one. Floats and booleans are rejected"""
+    if isinstance(value, bool) or not isinstance(value, (int, str)):
+        raise ValueError(f'{name} must be an integer')
+    return int(value)
+
+
+def parse_options(options):
+    """
+    Validate the segments options of a request, `true` for the defaults or
+    e.g. {"threshold": 0.6, "smoothing": 5, "minDuration": 3, "track": true}.
+    Raises ValueError if they are invalid
+    """
+    if options is True:
+        options = {}
+    if not isinstance(options, dict):
+        raise ValueError('segments must be true or an object')
+    parsed = {'threshold': float(options.get('threshold', THRESHOLD)),
+              'smoothing': parse_int(options.get('smoothing', SMOOTHING),
+                                      'smoothing'),
+              'min_duration': float(options.get('minDuration', MIN_DURATION)),
+              'track': parse_bool(options.get('track', False), 'track')}
+    if not 0 <= parsed['threshold'] <= 1:
+        raise ValueError('threshold must be between 0 and 1')
+    if not 1 <= parsed['smoothing'] <= MAX_SMOOTHING:
+        raise ValueError(f'smoothing must be between 1 and {MAX_SMOOTHING}')
+    if parsed['min_duration'] < 0:
+        raise ValueError('minDuration must not be negative')
+    return parsed
+
+
+def word_times(labelled_transcript):
+    """
+    Return the probability, start and end time of every word. Snippets only
+    have a start & end, so their duration is split evenly between the words
+    """
+    counts = np.array([len(s['label']) for s in labelled_transcript],
+                      dtype=np.int64)
+    n_words = int(counts.sum())
+    probs = np.fromiter(chain.from_iterable(
+        s['label'] for s in labelled_transcript), np.float64, n_words)
+    starts = np.array([s['start'] for s in labelled_transcript], np.float64)
+    ends = np.array([s['end'] for s in labelled_transcript], np.float64)
+
+    offsets = np.concatenate([[0], np.cumsum(counts)])
+    position = np.arange(n_words) - np.repeat(offsets[:-1], counts)
+    duration = np.repeat((ends - starts) / np.maximum(counts, 1), counts)
+    word_start = np.repeat(starts, counts) + position * duration
+    return probs, word_start, word_start + duration
+
+
+def smooth(probs, window):
+    """Centered moving average, averaging over fewer words at the edges"""
+    if window <= 1 or len(probs) == 0:
+        return probs
+    kernel = np.ones(window)
+    # the centered len(probs) values, 'same' gives window values if longer
+    start = (window - 1) // 2
+    stop = start + len(probs)
+    return (np.convolve(probs, kernel)[start:stop] /
+            np.convolve(np.ones(len(probs)), kernel)[start:stop])
+
+
+def sponsor_ranges(probs, word_start, word_end, threshold=THRESHOLD,
+                   smoothing=SMOOTHING, min_duration=MIN_DURATION):
+    """
+    Return [start, end, confidence] of the runs of words whose smoothed
+    probability is at least threshold. Runs that overlap in time (snippets
+    often do) are merged, then those shorter than min_duration are dropped.
+    The confidence is the mean probability of the words in a range
+    """
+    mask = smooth(probs, smoothing) >= threshold
+    edges = np.diff(np.concatenate([[0], mask.astype(np.int8), [0]]))
+    firsts = np.flatnonzero(edges == 1)
+    lasts = np.flatnonzero(edges == -1)
+    cumsum = np.concatenate([[0], np.cumsum(probs)])
+
+    merged = []
+    for first, last in zip(firsts.tolist(), lasts.tolist()):
+        start, end = float(word_start[first]), float(word_end[last - 1])
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+            merged[-1][3] = last
+        else:
+            merged.append([start, end, first, last])
+
+    return [[round(start, 2), round(end, 2),
+             round(float(cumsum[last] - cumsum[first]) / (last - first), 3)]
+            for start, end, first, last in merged
+            if end - start >= min_duration]
+
+
+def encode_track(probs):
+    """Quantize probabilities to uint8, base64 encoded"""
+    quantized = np.round(probs * 255).astype(np.uint8)
+    return base64.b64encode(quantized.tobytes()).decode('ascii')
+
+
+def summarize(labelled_transcript, threshold=THRESHOLD, smoothing=SMOOTHING,
+              min_duration=MIN_DURATION, track=False):
+    """Build the compact response body fields from a labelled transcript"""
+    probs, word_start, word_end = word_times(labelled_transcript)
+    body = {'segments': sponsor_ranges(probs, word_start, word_end, threshold,
+                                       smoothing, min_duration)}
+    if track:
+        # word i of the transcript has probability byte i / 255
+        body['track'] = encode_track(probs)
+    return body
@@ -1,7 +1,22 @@
 import json
+import os
 
-from app import predict_video
-from bottle import default_app, request, response, route, run
+import metrics
+import orjson
+from app import (WORKERS, after_fork, get_encoder, in_flight, negative_cache,
+                 predict_video, predict_videos, result_cache, stream_video)
+from bottle import JSONPlugin, default_app, request, response, route, run
+
+# dev: single threaded wsgiref server. gunicorn: load the model & encoder once,
+# then fork WORKERS processes of THREADS threads each
+SERVER_MODE = os.environ.get('SERVER_MODE', 'dev')
+HOST = os.environ.get('HOST', '127.0.0.1')
+PORT = int(os.environ.get('PORT', 8080))
+THREADS = int(os.environ.get('THREADS', 1))
+TIMEOUT = int(os.environ.get('WORKER_TIMEOUT', 60))
+GRACEFUL_TIMEOUT = int(os.environ.get('GRACEFUL_TIMEOUT', 30))
+# recycle workers after this many requests, 0 disables it
+MAX_REQUESTS = int(os.environ.get('MAX_REQUESTS', 0))
 
 
 @route('/predict', method='OPTIONS')
@@ -18,12 +33,79 @@ def predict_options():
 def predict():
     response.set_header('Access-Control-Allow-Origin', '*')
 
-    body = request.body.read().decode('utf-8')
-    vid = json.loads(body).get('vid')
-    return predict_video(vid)
+    response.content_type = 'application/json'
+
+    body = json.loads(request.body.read().decode('utf-8'))
+    return predict_video(body.get('vid'), timings=bool(body.get('timings')),
+                         segments=body.get('segments'), encode=True)
+
+
+@route('/predict_stream', method='OPTIONS')
+def predict_stream_options():
+    return predict_options()
+
+
+@route('/predict_stream', method='POST')
+def predict_stream():
+    """Stream the labelled snippets as newline delimited JSON"""
+    response.set_header('Access-Control-Allow-Origin', '*')
+    response.content_type = 'application/x-ndjson'
+
+    body = json.loads(request.body.read().decode('utf-8'))
+    return (b''.join(orjson.dumps(line) + b'\n' for line in lines)
+            for lines in stream_video(body.get('vid')))
+
+
+@route('/predict_batch', method='OPTIONS')
+def predict_batch_options():
+    return predict_options()
+
+
+@route('/predict_batch', method='POST')
+def predict_batch():
+    response.set_header('Access-Control-Allow-Origin', '*')
+
+    response.content_type = 'application/json'
+
+    body = json.loads(request.body.read().decode('utf-8'))
+    return predict_videos(body.get('vids'), timings=bool(body.get('timings')),
+                          segments=body.get('segments'), encode=True)
+
+
+@route('/stats', method='GET')
+def stats():
+    return {'resultCache': result_cache.stats(),
+            'negativeCache': negative_cache.stats(),
+            'singleFlight': in_flight.stats()}
+
+
+@route('/metrics', method='GET')
+def prometheus_metrics():
+    response.content_type = 'text/plain; version=0.0.4'
+    return metrics.render()
 
 
 app = default_app()
+# predictions come serialized by app, the other routes with orjson too
+app.uninstall(JSONPlugin)
+app.install(JSONPlugin(json_dumps=orjson.dumps))
+
+
+def serve(mode=SERVER_MODE, host=HOST, port=PORT):
+    if mode == 'dev':
+        run(app, host=host, port=port)
+    elif mode == 'gunicorn':
+        # shared copy-on-write by the workers, like the model
+        get_encoder()
+        run(app, server='gunicorn', host=host, port=port,
+            workers=WORKERS, threads=THREADS, preload_app=True,
+            post_fork=lambda server, worker: after_fork(),
+            timeout=TIMEOUT, graceful_timeout=GRACEFUL_TIMEOUT,
+            max_requests=MAX_REQUESTS,
+            max_requests_jitter=MAX_REQUESTS // 10)
+    else:
+        raise ValueError(f'Unknown SERVER_MODE {mode}')
+
 
 if __name__ == '__main__':
-    run(host='127.0.0.1', port=8080)
+    serve()
@@ -0,0 +1,57 @@
+import threading
+from concurrent.futures import Future
+
+
+class SingleFlight(object):
+    """Deduplicate concurrent calls by key.
+
+    The first caller for a key runs the function, callers arriving while it
+    runs wait for its result instead of running it again. Errors raised by
+    the function are raised in every waiting caller. Results are not kept
+    once the call is done, cache them separately, and pass a `lookup` of
+    that cache: a caller that missed it just before the previous call
+    stored its result would otherwise run the function again.
+    """
+
+    def __init__(self):
+        self.deduplicated = 0
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn, timeout=None, lookup=None):
+        """
+        Run fn, or wait for the running call for key. Returns the result and
+        whether it was shared from another call. If lookup is given, the
+        first caller returns what it returns instead of running fn, unless
+        it is None. Waiting callers raise TimeoutError after timeout
+        seconds, the running call is not affected
+        """
+        with self._lock:
+            future = self._calls.get(key)
+            shared = future is not None
+            if shared:
+                self.deduplicated += 1
+            else:
+                future = self._calls[key] = Future()
+
+        if shared:
+            return future.result(timeout), True
+
+        try:
+            result = lookup() if lookup is not None else None
+            shared = result is not None
+            if not shared:
+                result = fn()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result, shared
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+    def stats(self):
+        return {'deduplicated': self.deduplicated,
+                'inFlight': len(self._calls)}
@@ -0,0 +1,100 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from requests import Session
+from requests.adapters import HTTPAdapter
+from youtube_transcript_api import YouTubeTranscriptApi
+from youtube_transcript_api.proxies import GenericProxyConfig
+
+LANGUAGES = ['en', 'en-US', 'en-GB']
+
+
+class TranscriptClient(object):
+    """Long-lived transcript client with pooled, keep-alive HTTP connections.
+
+    `YouTubeTranscriptApi` is not thread-safe, so every thread gets its own
+    API instance and session. All sessions mount the same `HTTPAdapter`, whose
+    connection pools are shared across requests and threads, so connections
+    to YouTube or the proxy are set up once and then reused.
+
+    # Arguments
+        proxy_config: optional `ProxyConfig` for `YouTubeTranscriptApi`.
+        pool_connections: number of hosts to keep connection pools for.
+        pool_maxsize: maximum number of connections per host. Requests
+            beyond it wait for a connection to be free.
+        max_retries: retries on connection errors, e.g. a stale connection.
+        max_workers: number of threads used by `fetch_many`.
+        api_factory: callable taking a `requests.Session` and returning an
+            object with a `fetch(vid, languages)` method. Defaults to
+            `YouTubeTranscriptApi`. Replace it to run the client against a
+            local stand-in transcript server.
+    """
+
+    def __init__(self, proxy_config=None, pool_connections=4, pool_maxsize=8,
+                 max_retries=1, max_workers=8, api_factory=None):
+        self.proxy_config = proxy_config
+        self.max_workers = max_workers
+        self.api_factory = api_factory or self._default_api
+        self.adapter = HTTPAdapter(pool_connections=pool_connections,
+                                   pool_maxsize=pool_maxsize,
+                                   max_retries=max_retries,
+                                   pool_block=True)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._executor = None
+
+    @classmethod
+    def from_env(cls):
+        """Build a client configured by environmental variables"""
+        http_url = os.environ.get('PROXY_HTTP_URL')
+        https_url = os.environ.get('PROXY_HTTPS_URL')
+        proxy_config = None
+        if http_url or https_url:
+            proxy_config = GenericProxyConfig(http_url=http_url,
+                                              https_url=https_url)
+        max_workers = int(os.environ.get('FETCH_WORKERS', 8))
+        return cls(proxy_config=proxy_config,
+                   pool_maxsize=int(os.environ.get('FETCH_POOL_SIZE', max_workers)),
+                   max_workers=max_workers)
+
+    def _default_api(self, session):
+        return YouTubeTranscriptApi(proxy_config=self.proxy_config,
+                                    http_client=session)
+
+    def _api(self):
+        api = getattr(self._local, 'api', None)
+        if api is None:
+            session = Session()
+            session.mount('http://', self.adapter)
+            session.mount('https://', self.adapter)
+            api = self._local.api = self.api_factory(session)
+        return api
+
+    def fetch(self, vid, languages=LANGUAGES):
+        return self._api().fetch(vid, languages=languages)
+
+    def fetch_many(self, vids, languages=LANGUAGES):
+        """
+        Fetch transcripts concurrently. Returns a list in the order of vids,
+        with the raised exception in place of each failed fetch
+        """
+        def fetch(vid):
+            try:
+                return self.fetch(vid, languages)
+            except Exception as e:
+                return e
+
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.max_workers,
+                    thread_name_prefix='transcript')
+        return list(self._executor.map(fetch, vids))
+
+    def close(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
+        self.adapter.close()
@@ -1,8 +1,11 @@
 import json
 from collections import OrderedDict, defaultdict
+from itertools import repeat
 
 import numpy as np
 
+FILTERS = '!"#$%&()*+,-./:;<=>?@[\\]^_`{|}~\t\n'
+
 
 def text_to_word_sequence(text,
                           filters='!"#$%&()*+,-./:;<=>?@[\\]^_`{|}~\t\n',
@@ -139,6 +142,95 @@ class Tokenizer(object):
             yield vect
 
 
+class TranscriptEncoder(object):
+    """Fused text normalizer and tokenizer for transcript snippets.
+
+    Gives the same result as stripping the punctuation of every snippet,
+    joining them and running the text through `Tokenizer.texts_to_sequences`,
+    but in a single pass with tables that are built once.
+
+    # Arguments
+        word_index: dictionary mapping words to token ids.
+        num_words: the maximum number of words to keep, as in `Tokenizer`.
+        oov_token: out-of-vocabulary token, as in `Tokenizer`.
+        filters: characters that are replaced by a space.
+    """
+
+    def __init__(self, word_index, num_words=None, oov_token=None,
+                 filters=FILTERS):
+        oov_token_index = word_index.get(oov_token)
+        self.default = -1 if oov_token_index is None else oov_token_index
+        self.lookup = {w: i if not num_words or i < num_words else self.default
+                       for w, i in word_index.items()}
+        self.lookup[''] = -1
+        # filters are ASCII, so they can be replaced on the UTF-8 bytes
+        self.table = bytes.maketrans(filters.encode(), b' ' * len(filters))
+
+    @classmethod
+    def from_tokenizer(cls, tokenizer):
+        return cls(tokenizer.word_index, tokenizer.num_words,
+                   tokenizer.oov_token, tokenizer.filters)
+
+    @classmethod
+    def from_vocabulary(cls, vocabulary):
+        """Build from a compact `vocab.Vocabulary`, num_words already applied"""
+        return cls(vocabulary.word_index(), None,
+                   vocabulary.oov_token, vocabulary.filters)
+
+    def _translate(self, text):
+        """Drop non-breaking spaces, turn punctuation runs to single spaces"""
+        text = (text.replace('\xa0', '')
+                .encode('utf-8', 'surrogatepass')
+                .translate(self.table)
+                .decode('utf-8', 'surrogatepass'))
+        while '  ' in text:
+            text = text.replace('  ', ' ')
+        return text
+
+    def normalize(self, texts):
+        """Normalize a list of texts, same as `strip_punctuations` on each"""
+        # translate all texts at once, NUL is neither filtered nor stripped
+        joined = '\0'.join(texts)
+        if joined.count('\0') != len(texts) - 1:
+            return [self._translate(t).strip() for t in texts]
+        return [t.strip() for t in self._translate(joined).split('\0')]
+
+    def tokenize(self, segments):
+        """Tokenize a list of normalized texts.
+
+        # Arguments
+            segments: A list of normalized texts (strings).
+
+        # Returns
+            A tuple of an int32 array with one token id per word (-1 for
+            words that map to no token) and an int64 array with the word
+            offset of every text, followed by the word count.
+        """
+        offsets = np.zeros(len(segments) + 1, dtype=np.int64)
+        np.cumsum([s.count(' ') + 1 for s in segments], out=offsets[1:])
+
+        words = ' '.join(segments).lower().split(' ')
+        ids = np.fromiter(map(self.lookup.get, words, repeat(self.default)),
+                          dtype=np.int32, count=len(words))
+
+        return ids, offsets
+
+    def encode(self, texts):
+        """Normalize and tokenize a list of snippets.
+
+        # Arguments
+            texts: A list of texts (strings).
+
+        # Returns
+            A tuple of the normalized texts, followed by the output
+            of `tokenize`.
+        """
+        segments = self.normalize(texts)
+        ids, offsets = self.tokenize(segments)
+
+        return segments, ids, offsets
+
+
 def tokenizer_from_json(json_string):
     """Parses a JSON tokenizer configuration file and returns a
     tokenizer instance.
@@ -0,0 +1,124 @@
+"""
+Compact vocabulary for fast cold starts. Exports the parts of the Keras
+tokenizer that inference reads into a directory of arrays:
+
+    words.npy    uint8, the sorted UTF-8 words, each followed by a newline
+    ids.npy      int32, the token id of every word
+    config.json  OOV token & id, the filters and the digest of the
+                 tokenizer.json it was exported from
+
+Only words with their own token id are kept, i.e. the top `num_words - 1`
+words; the others map to the OOV token anyway. The backend only loads it
+while the digest matches tokenizer.json. To export it from
+./model/tokenizer.json and compare the startup of both formats, run:
+
+    python vocab.py
+"""
+import json
+import os
+import tracemalloc
+from time import perf_counter
+
+import numpy as np
+
+from cache import file_digest
+from utils import TranscriptEncoder, tokenizer_from_json
+
+TOKENIZER = os.path.join('.', 'model', 'tokenizer.json')
+VOCAB = os.path.join('.', 'model', 'vocab')
+FILES = ['words.npy', 'ids.npy', 'config.json']
+
+
+def export_vocab(tokenizer, path=VOCAB, tokenizer_path=TOKENIZER):
+    oov_token_index = tokenizer.word_index.get(tokenizer.oov_token)
+    vocab = sorted(
+        (w.encode('utf-8'), i) for w, i in tokenizer.word_index.items()
+        if (not tokenizer.num_words or i < tokenizer.num_words)
+        and i != oov_token_index)
+
+    words = b''.join(w + b'\n' for w, _ in vocab)
+
+    os.makedirs(path, exist_ok=True)
+    np.save(os.path.join(path, 'words.npy'), np.frombuffer(words, np.uint8))
+    np.save(os.path.join(path, 'ids.npy'),
+            np.array([i for _, i in vocab], dtype=np.int32))
+    with open(os.path.join(path, 'config.json'), 'w') as f:
+        json.dump({'oov_token': tokenizer.oov_token,
+                   'oov_token_index': oov_token_index,
+                   'filters': tokenizer.filters,
+                   'tokenizer_digest': file_digest(tokenizer_path)}, f)
+
+
+class Vocabulary(object):
+    """Compact vocabulary, see the module docstring"""
+
+    def __init__(self, path=VOCAB):
+        self.words = np.load(os.path.join(path, 'words.npy'))
+        self.ids = np.load(os.path.join(path, 'ids.npy'))
+        with open(os.path.join(path, 'config.json'), 'r') as f:
+            config = json.load(f)
+        self.oov_token = config['oov_token']
+        self.oov_token_index = config['oov_token_index']
+        self.filters = config['filters']
+        # None if exported before the digest was recorded
+        self.tokenizer_digest = config.get('tokenizer_digest')
+
+    def __len__(self):
+        return len(self.ids)
+
+    def word_index(self):
+        """Return a dictionary mapping the words (and OOV token) to token ids"""
+        words = self.words.tobytes().decode('utf-8').split('\n')[:-1]
+        word_index = dict(zip(words, self.ids.tolist()))
+        if self.oov_token is not None:
+            word_index[self.oov_token] = self.oov_token_index
+        return word_index
+
+
+def measure(fn, repeat=5):
+    """Return the best wall time and the peak traced memory of fn"""
+    times = []
+    for _ in range(repeat):
+        t_start = perf_counter()
+        fn()
+        times.append(perf_counter() - t_start)
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return min(times), peak
+
+
+def main():
+    def load_json():
+        with open(TOKENIZER, 'r') as fp:
+            tokenizer = tokenizer_from_json(json.load(fp))
+        return TranscriptEncoder.from_tokenizer(tokenizer)
+
+    def load_compact():
+        return TranscriptEncoder.from_vocabulary(Vocabulary(VOCAB))
+
+    with open(TOKENIZER, 'r') as fp:
+        tokenizer = tokenizer_from_json(json.load(fp))
+    export_vocab(tokenizer, VOCAB)
+    size = sum(os.path.getsize(os.path.join(VOCAB, f)) for f in FILES)
+    print(f'Exported {len(Vocabulary(VOCAB))} words to {VOCAB} '
+          f'({size / 2 ** 10:.0f} KiB, tokenizer.json is '
+          f'{os.path.getsize(TOKENIZER) / 2 ** 10:.0f} KiB)')
+
+    # both encoders must map every word to the same token id
+    json_encoder, compact_encoder = load_json(), load_compact()
+    default = json_encoder.default
+    assert compact_encoder.default == default
+    assert all(json_encoder.lookup.get(w, default) ==
+               compact_encoder.lookup.get(w, default)
+               for w in tokenizer.word_index)
+
+    print(f'{"format":>8} {"load ms":>8} {"peak MiB":>9}')
+    for name, fn in [('json', load_json), ('compact', load_compact)]:
+        t, peak = measure(fn)
+        print(f'{name:>8} {t * 1000:>8.1f} {peak / 2 ** 20:>9.1f}')
+
+
+if __name__ == '__main__':
+    main()
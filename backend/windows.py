@@ -0,0 +1,97 @@
+"""
+Model input windows: transcripts are cut into windows of MAX_LEN token ids,
+each overlapping the previous one by OVERLAP, and the model outputs of the
+windows are stitched back together.
+"""
+import numpy as np
+
+MAX_LEN = 3000
+OVERLAP = 800
+
+
+def get_split_index(len_arr, max_len=MAX_LEN, overlap=OVERLAP):
+    """
+    To split a long list into shorter ones with max_len and an overlap at front
+    Returns the index where the list should be split
+    """
+    if len_arr <= max_len:
+        return [[0, len_arr]]
+    else:
+        splits = [[0, max_len]]
+    i = 1
+    while True:
+        if ((max_len-overlap)*i+max_len) >= len_arr:
+            break
+        else:
+            splits.append([(max_len-overlap)*i, ((max_len-overlap)*i+max_len)])
+        i += 1
+    splits.append([(max_len-overlap)*i, len_arr])
+
+    return splits
+
+
+def prepare_X(ids, max_len=MAX_LEN, overlap=OVERLAP, dtype=np.float32):
+    """
+    Split per-word token ids to windows of max_len with an overlap at front,
+    padded at the end. Words without a token (-1) are dropped from their window
+    """
+    split_index = get_split_index(len(ids), max_len, overlap)
+    valid = ids >= 0
+    if valid.all():
+        # windows start every max_len-overlap tokens, so they are a strided
+        # view over a single zero padded buffer
+        buffer = np.zeros(split_index[-1][0] + max_len, dtype=dtype)
+        buffer[:len(ids)] = ids
+        return np.lib.stride_tricks.sliding_window_view(
+            buffer, max_len)[::max_len-overlap]
+
+    tokens = ids[valid]
+    token_index = np.concatenate([[0], np.cumsum(valid)])
+    X = np.zeros((len(split_index), max_len), dtype=dtype)
+    for row, (start, end) in zip(X, split_index):
+        window = tokens[token_index[start]:token_index[end]]
+        row[:len(window)] = window
+
+    return X
+
+
+def window_lengths(n_words, max_len=MAX_LEN, overlap=OVERLAP):
+    """
+    Number of words covered by each window. Stitching reads the outputs of
+    all these positions, even where words without a token left padding
+    """
+    return np.array([end - start for start, end in
+                     get_split_index(n_words, max_len, overlap)], np.int64)
+
+
+def run_buckets(X, infer, buckets, lengths=None):
+    """
+    Run infer over X, each window cut to the smallest bucket length that
+    holds its first `lengths` positions, by default all its tokens. Outputs
+    past a window's bucket are left zero
+    """
+    if lengths is None:
+        # windows are post padded and 0 is never a token
+        lengths = np.count_nonzero(X, axis=1)
+    bucket_index = np.searchsorted(buckets, np.minimum(lengths, X.shape[1]))
+    results = None
+    for i in np.unique(bucket_index):
+        rows = np.flatnonzero(bucket_index == i)
+        length = buckets[i]
+        output = infer(X[rows, :length])
+        if results is None:
+            results = np.zeros(X.shape + output.shape[2:], output.dtype)
+        results[rows, :length] = output
+
+    return results
+
+
+def stitch_predictions(predictions, max_len=MAX_LEN, overlap=OVERLAP):
+    """
+    stitch the sponsor probabilities of raw predictions together, discarding
+    the end of each segment
+    """
+    probs = predictions[..., 1]
+    stitched = np.concatenate([probs[:-1, :max_len-overlap].ravel(), probs[-1]])
+
+    return np.round(stitched.astype(np.float64), 3)  # still has padding
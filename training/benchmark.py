@@ -0,0 +1,669 @@
+"""
+Offline benchmarks for the training data pipeline, on synthetic data. Run them
+in the training directory, e.g.:
+
+    python benchmark.py timestamps --rows 5000000
+    python benchmark.py labeller --snippets 2000 20000
+    python benchmark.py cleaner --videos 100000
+    python benchmark.py corpus --videos 100000
+    python benchmark.py vectors --words 1000000
+    python benchmark.py dataset --videos 1000 4000
+    python benchmark.py reshape --videos 1000 4000
+"""
+import argparse
+import io
+import json
+import multiprocessing
+import os
+import re
+from itertools import islice
+from time import perf_counter
+
+import numpy as np
+import pandas as pd
+
+from .cleaner import write_text_labels
+from .corpus import (RAW_COLUMNS, TEXT_LABEL_COLUMNS, TOKEN_COLUMNS, Corpus,
+                     iter_legacy_raw, iter_legacy_text_labels, write_atomic)
+from .dataset import MAX_LEN
+from .dataset import OVERLAP as WINDOW_OVERLAP
+from .dataset import WindowStream, get_split_index, reshape_data
+from .labeller import OVERLAP, label_snippets
+from .scraper import read_timestamps
+from .vectors import embedding_matrix
+
+SYNTHETIC_DIR = os.path.join(os.getcwd(), 'data', 'synthetic')
+CATEGORIES = ['sponsor', 'selfpromo', 'interaction', 'intro', 'outro',
+              'preview', 'music_offtopic', 'filler']
+
+
+def measure(fn, *args):
+    """
+    Run fn in a fresh process. Returns its result, wall time and the peak
+    resident memory it added, in MiB
+    """
+    with multiprocessing.get_context('spawn').Pool(1) as pool:
+        return pool.apply(_measure, (fn,) + args)
+
+
+def peak_rss():
+    """Peak resident memory of this process in KiB. Unlike ru_maxrss, it is
+    not inherited from the parent of a spawned process (Linux only)"""
+    with open('/proc/self/status', 'r') as f:
+        for line in f:
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1])
+
+
+def _measure(fn, *args):
+    rss_before = peak_rss()
+    t_start = perf_counter()
+    result = fn(*args)
+    t = perf_counter() - t_start
+    return result, t, (peak_rss() - rss_before) / 2 ** 10
+
+
+def hex_ids(rng, n, length):
+    """Random lowercase hex strings, like the ids & hashes in the dump"""
+    digits = np.frombuffer(b'0123456789abcdef', dtype='S1')
+    chars = digits[rng.integers(0, 16, (n, length))]
+    return chars.view(f'S{length}').ravel().astype(str)
+
+
+def make_sponsor_times(path, rows, seed=0, block=500000):
+    """Write a synthetic sponsorTimes.csv with the columns of the real dump"""
+    rng = np.random.default_rng(seed)
+    video_ids = hex_ids(rng, max(1, rows // 4), 11)
+    written = 0
+    while written < rows:
+        n = min(block, rows - written)
+        start = np.round(rng.uniform(0, 3600, n), 3)
+        df = pd.DataFrame({
+            'videoID': video_ids[rng.integers(0, len(video_ids), n)],
+            'startTime': start,
+            'endTime': np.round(start + rng.uniform(5, 120, n), 3),
+            'votes': rng.integers(-2, 30, n),
+            'locked': rng.integers(0, 2, n),
+            'incorrectVotes': rng.integers(0, 3, n),
+            'UUID': hex_ids(rng, n, 64),
+            'userID': hex_ids(rng, n, 64),
+            'timeSubmitted': rng.integers(1560000000000, 1660000000000, n),
+            'views': rng.integers(0, 10000, n),
+            'category': np.array(CATEGORIES)[rng.integers(0, 8, n)],
+            'actionType': 'skip',
+            'service': 'YouTube',
+            'videoDuration': np.round(rng.uniform(0, 7200, n), 3),
+            'hidden': 0,
+            'reputation': np.round(rng.uniform(0, 30, n), 2),
+            'shadowHidden': (rng.random(n) < 0.05).astype(int),
+            'hashedVideoID': hex_ids(rng, n, 64),
+            'userAgent': 'chromiumExtension/5.0.0',
+            'description': '',
+        })
+        df.to_csv(path, mode='w' if written == 0 else 'a',
+                  header=written == 0, index=False)
+        written += n
+
+
+def legacy_timestamps(path):
+    """get_timestamps before the chunked reader, from a local path"""
+    raw = pd.read_csv(path)
+    df = raw[(raw.votes >= 10) & (raw.shadowHidden == 0)
+             ][['videoID',  'startTime', 'endTime']]
+    df['time'] = df.apply(lambda x: f'{x.startTime},{x.endTime}', axis=1)
+
+    df_ts = (df
+             .groupby(['videoID'])['time']
+             .apply(';'.join)
+             .apply(lambda s: [[float(y) for y in x] for x in [i.split(',') for i in s.split(';')]])
+             .reset_index())
+    return df_ts.to_json()
+
+
+def chunked_timestamps(path):
+    return read_timestamps(path)
+
+
+def timestamps_json(vids, bounds, times):
+    """The timestamps file the legacy reader wrote, from the chunked arrays"""
+    return pd.DataFrame({'videoID': vids,
+                         'time': [times[start:end].tolist() for start, end
+                                  in zip(bounds[:-1], bounds[1:])]}).to_json()
+
+
+def bench_timestamps(rows, seed):
+    os.makedirs(SYNTHETIC_DIR, exist_ok=True)
+    path = os.path.join(SYNTHETIC_DIR, f'sponsorTimes_{rows}_{seed}.csv')
+    if not os.path.isfile(path):
+        print(f'Writing {rows} rows to {path}...')
+        make_sponsor_times(path, rows, seed)
+    print(f'CSV is {os.path.getsize(path) / 2 ** 20:.0f} MiB')
+
+    print(f'{"reader":>8} {"seconds":>8} {"peak MiB":>9}')
+    results = {}
+    for name, fn in [('legacy', legacy_timestamps),
+                     ('chunked', chunked_timestamps)]:
+        results[name], t, peak = measure(fn, path)
+        print(f'{name:>8} {t:>8.1f} {peak:>9.0f}')
+    # the timestamps file must not change
+    assert results['legacy'] == timestamps_json(*results['chunked'])
+
+
+def best_of(fn, repeat=5):
+    """Return the result and the best wall time of several runs of fn"""
+    times = []
+    for _ in range(repeat):
+        t_start = perf_counter()
+        result = fn()
+        times.append(perf_counter() - t_start)
+    return result, min(times)
+
+
+def make_caption(n_snippets, n_segments, seed=0):
+    """Synthetic caption frame, as fetched by the scraper, and segments"""
+    rng = np.random.default_rng(seed)
+    duration = rng.uniform(1, 6, n_snippets)
+    # snippets overlap a little, like auto-generated captions
+    start = np.concatenate([[0], np.cumsum(duration)[:-1] * 0.95])
+    cap = pd.DataFrame({'text': 'lorem ipsum', 'start': start,
+                        'end': start + duration})
+    seg_start = rng.uniform(0, cap.end.iloc[-1], n_segments)
+    segments = np.stack([seg_start, seg_start + rng.uniform(5, 90, n_segments)],
+                        axis=1).tolist()
+    return cap, segments
+
+
+def legacy_label(cap, ts_ranges):
+    """The scraper's labelling before labeller.py"""
+    cap = cap.copy()
+    cap['label'] = 0
+    for ts in eval(str(ts_ranges)):
+        mask = (cap.start >= ts[0]) & (cap.end <= ts[1])
+        cap.loc[mask, 'label'] = 1
+    return cap.label.to_numpy()
+
+
+def legacy_overlap_label(cap, ts_ranges):
+    """Overlap semantics in the legacy style, as the parity reference"""
+    label = np.zeros(len(cap), dtype=np.uint8)
+    for ts in ts_ranges:
+        label[(cap.start < ts[1]) & (cap.end > ts[0])] = 1
+    return label
+
+
+def bench_labeller(snippets_list, segments_list):
+    print(f'{"snippets":>9} {"segments":>9} {"legacy ms":>10} '
+          f'{"vectorized ms":>14} {"speedup":>8} {"overlap ms":>11}')
+    for n_snippets in snippets_list:
+        for n_segments in segments_list:
+            cap, segments = make_caption(n_snippets, n_segments)
+            legacy, t_legacy = best_of(lambda: legacy_label(cap, segments), 3)
+            fast, t_fast = best_of(
+                lambda: label_snippets(cap.start, cap.end, segments))
+            assert np.array_equal(legacy, fast)
+            overlap, t_overlap = best_of(lambda: label_snippets(
+                cap.start, cap.end, segments, OVERLAP))
+            assert np.array_equal(legacy_overlap_label(cap, segments), overlap)
+            assert (overlap >= fast).all()
+
+            print(f'{n_snippets:>9} {n_segments:>9} {t_legacy * 1000:>10.1f} '
+                  f'{t_fast * 1000:>14.2f} {t_legacy / t_fast:>7.0f}x '
+                  f'{t_overlap * 1000:>11.2f}')
+
+
+WORDS = np.array(['the', 'a', 'video', 'sponsor', "don't", 'VPN', 'today',
+                  'code', '10%', 'off', 'link', 'below', '[Music]', 'so',
+                  'e-mail', 'U.S.', 'A&B', '>>', 'thanks', 'to', 'café',
+                  '2021', 'okay,', 'right.', 'what?!', 'a;b', '"quote"',
+                  ';<', '<3', 'x;;<y', '\t', 'a\\b'])
+
+
+def make_raw(path, n_videos, seed=0):
+    """Write a synthetic raw.jsonl of transcripts, as stored by the scraper"""
+    rng = np.random.default_rng(seed)
+    with open(path, 'w') as f:
+        for v in range(n_videos):
+            n_snippets = int(rng.integers(20, 180))
+            words = WORDS[rng.integers(0, len(WORDS), n_snippets * 8)].tolist()
+            cuts = np.cumsum(rng.integers(1, 15, n_snippets)).tolist()
+            texts = [' '.join(words[i:j]) for i, j in
+                     zip([0] + cuts[:-1], cuts)]
+            # a few non-breaking spaces & line breaks, as in auto captions
+            texts[0] = texts[0].replace(' ', '\xa0', 1)
+            texts[-1] = texts[-1] + '\n'
+            start = np.round(np.cumsum(rng.uniform(1, 6, n_snippets)), 3)
+            label = (rng.random(n_snippets) < 0.1).astype(int).tolist()
+            index = [str(i) for i in range(n_snippets)]
+            transcript = json.dumps({
+                'text': dict(zip(index, texts)),
+                'start': dict(zip(index, start.tolist())),
+                'end': dict(zip(index, (start + 2).tolist())),
+                'label': dict(zip(index, label))})
+            f.write(json.dumps({'vid': f'v{v}', 'transcript': transcript})
+                    + '\n')
+
+
+def iter_transcripts(path):
+    with open(path, 'r') as f:
+        for line in f:
+            yield json.loads(line)['transcript']
+
+
+def legacy_extend_labels(df):
+    text_len = len(df['text'].split(' '))
+    return text_len * [df['label']]
+
+
+def legacy_strip_punctuations(s):
+    PUNCTUATIONS = "(!|\"|#|\$|%|&|\(|\)|\*|\+|,|-|\.|/|:|;\<|=|>|\?|@|\[|\\\\|\]|\^|_|`|\{|\||\}|~|\t|\n)+"
+    s = s.replace(u'\xa0', u'')
+    return re.sub("  +", " ", re.sub(PUNCTUATIONS, " ", s)).strip()
+
+
+def legacy_text_labels(transcripts, path):
+    """The preprocessor's get_text_labels before cleaner.py"""
+    all_text = []
+    all_labels = []
+    for val in transcripts:
+        df = pd.read_json(io.StringIO(val))
+        df.text = df.text.apply(legacy_strip_punctuations)
+        text_ = ' '.join(df.text.to_list())
+        all_text.append(text_)
+
+        df['labels'] = df.apply(legacy_extend_labels, axis=1)
+
+        labels_ = []
+        for l in df.labels.to_list():
+            labels_.extend(l)
+        all_labels.append(labels_)
+
+    text_labels_dict = {'text': all_text, 'labels': all_labels}
+
+    with open(path, 'w') as f:
+        json.dump(text_labels_dict, f)
+
+
+def synthetic_raw(n_videos, seed):
+    """Return the paths of a synthetic raw.jsonl and the raw corpus of it"""
+    os.makedirs(SYNTHETIC_DIR, exist_ok=True)
+    raw_jsonl = os.path.join(SYNTHETIC_DIR, f'raw_{n_videos}_{seed}.jsonl')
+    if not os.path.isfile(raw_jsonl):
+        print(f'Writing {n_videos} videos to {raw_jsonl}...')
+        make_raw(raw_jsonl, n_videos, seed)
+    raw = os.path.join(SYNTHETIC_DIR, f'raw_{n_videos}_{seed}')
+    if not os.path.isdir(raw):
+        print(f'Converting {raw_jsonl} to a corpus...')
+        write_atomic(raw, RAW_COLUMNS, iter_legacy_raw(None, raw_jsonl))
+    return raw_jsonl, raw
+
+
+def bench_cleaner(n_videos, workers_list, seed):
+    raw_jsonl, raw = synthetic_raw(n_videos, seed)
+    print(f'raw.jsonl is {os.path.getsize(raw_jsonl) / 2 ** 20:.0f} MiB')
+
+    legacy_path = os.path.join(SYNTHETIC_DIR, 'text_labels_legacy.json')
+    t_start = perf_counter()
+    legacy_text_labels(iter_transcripts(raw_jsonl), legacy_path)
+    t_legacy = perf_counter() - t_start
+    print(f'{"workers":>8} {"seconds":>8} {"speedup":>8}')
+    print(f'{"legacy":>8} {t_legacy:>8.1f}')
+
+    with open(legacy_path, 'r') as f:
+        legacy = json.load(f)
+    path = os.path.join(SYNTHETIC_DIR, 'text_labels')
+    for workers in workers_list:
+        t_start = perf_counter()
+        write_text_labels(raw, path, workers)
+        t = perf_counter() - t_start
+        # the texts & labels must not change
+        corpus = Corpus(path)
+        assert corpus.strings('text') == legacy['text']
+        assert all(np.array_equal(a, b) for a, b
+                   in zip(corpus.arrays('label'), legacy['labels']))
+        print(f'{workers:>8} {t:>8.1f} {t_legacy / t:>7.1f}x')
+    os.remove(legacy_path)
+
+
+def legacy_load_raw(path):
+    """Parse raw.jsonl & its transcripts, as every stage did"""
+    n_snippets = n_labels = 0
+    with open(path, 'r') as f:
+        for line in f:
+            df = pd.read_json(io.StringIO(json.loads(line)['transcript']))
+            n_snippets += len(df)
+            n_labels += int(df.label.sum())
+    return n_snippets, n_labels
+
+
+def corpus_load_raw(path):
+    corpus = Corpus(path)
+    return len(corpus.values('label')), int(corpus.values('label').sum())
+
+
+def legacy_load_text_labels(path):
+    """Load text_labels.json, as the trainer did"""
+    with open(path, 'r') as f:
+        data = pd.DataFrame(json.loads(f.read()))
+    return (sum(map(len, data.text.values)),
+            sum(sum(labels) for labels in data.labels.values))
+
+
+def corpus_load_text_labels(path):
+    """Load the text & labels corpus, as the trainer does"""
+    corpus = Corpus(path)
+    texts, labels = corpus.strings('text'), corpus.arrays('label')
+    return (sum(map(len, texts)),
+            sum(int(label.sum()) for label in labels))
+
+
+def disk_size(path):
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(path, name))
+               for name in os.listdir(path))
+
+
+def bench_corpus(n_videos, seed):
+    raw_jsonl, raw = synthetic_raw(n_videos, seed)
+    text_labels_json = os.path.join(SYNTHETIC_DIR,
+                                    f'text_labels_{n_videos}_{seed}.json')
+    if not os.path.isfile(text_labels_json):
+        legacy_text_labels(iter_transcripts(raw_jsonl), text_labels_json)
+    text_labels = os.path.join(SYNTHETIC_DIR, f'text_labels_{n_videos}_{seed}')
+    if not os.path.isdir(text_labels):
+        write_atomic(text_labels, TEXT_LABEL_COLUMNS,
+                     iter_legacy_text_labels(text_labels_json))
+
+    print(f'{"data":>12} {"format":>7} {"disk MiB":>9} {"seconds":>8} '
+          f'{"peak MiB":>9}')
+    for data, formats in [
+            ('raw', [('json', legacy_load_raw, raw_jsonl),
+                     ('corpus', corpus_load_raw, raw)]),
+            ('text_labels', [('json', legacy_load_text_labels,
+                              text_labels_json),
+                             ('corpus', corpus_load_text_labels,
+                              text_labels)])]:
+        results = []
+        for name, fn, path in formats:
+            result, t, peak = measure(fn, path)
+            results.append(result)
+            print(f'{data:>12} {name:>7} {disk_size(path) / 2 ** 20:>9.0f} '
+                  f'{t:>8.2f} {peak:>9.0f}')
+        # both formats hold the same data
+        assert results[0] == results[1]
+
+
+def make_vec(path, n_words, dim, seed=0, block=10000):
+    """Write a synthetic .vec file, formatted as the fastText one"""
+    rng = np.random.default_rng(seed)
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(f'{n_words} {dim}\n')
+        for first in range(0, n_words, block):
+            n = min(block, n_words - first)
+            values = np.round(rng.normal(0, 0.1, (n, dim)), 4).astype(str)
+            f.writelines(f'w{first + i}{"é" if (first + i) % 100 == 0 else ""} '
+                         f'{" ".join(row)}\n' for i, row in enumerate(values))
+
+
+def make_word_index(n_words, vocabulary, seed=0):
+    """A tokenizer's word_index, with 10% of the words not in the .vec file"""
+    rng = np.random.default_rng(seed)
+    ids = rng.choice(n_words, vocabulary, replace=False)
+    words = [f'w{i}{"é" if i % 100 == 0 else ""}' for i in ids]
+    words[::10] = [f'oov{i}' for i in range(len(words[::10]))]
+    return {word: i + 1 for i, word in enumerate(words)}
+
+
+def legacy_embedding_matrix(fname, word_index, num_words):
+    """The preprocessor's load_vectors & train_embedding before vectors.py"""
+    fin = io.open(fname, 'r', encoding='utf-8', newline='\n', errors='ignore')
+    n, d = map(int, fin.readline().split())
+    data = {}
+    for line in fin:
+        tokens = line.rstrip().split(' ')
+        data[tokens[0]] = np.array(list(map(float, tokens[1:])))
+
+    embedding_matrix = np.zeros((num_words, 300))
+    for word, i in word_index.items():
+        if i >= num_words:
+            continue
+        embedding_vector = data.get(word)
+        if embedding_vector is not None:
+            embedding_matrix[i] = list(embedding_vector)
+    return embedding_matrix
+
+
+def bench_vectors(n_words, vocabulary, seed):
+    os.makedirs(SYNTHETIC_DIR, exist_ok=True)
+    path = os.path.join(SYNTHETIC_DIR, f'vectors_{n_words}_{seed}.vec')
+    if not os.path.isfile(path):
+        print(f'Writing {n_words} vectors to {path}...')
+        make_vec(path, n_words, 300, seed)
+    print(f'.vec file is {os.path.getsize(path) / 2 ** 20:.0f} MiB')
+    word_index = make_word_index(n_words, vocabulary, seed)
+    num_words = min(10000, len(word_index) + 1)
+
+    print(f'{"loader":>10} {"seconds":>8} {"peak MiB":>9}')
+    results = {}
+    for name, fn in [('legacy', legacy_embedding_matrix),
+                     ('filtered', embedding_matrix)]:
+        results[name], t, peak = measure(fn, path, word_index, num_words)
+        print(f'{name:>10} {t:>8.1f} {peak:>9.0f}')
+    # same vectors, stored as float32
+    assert np.array_equal(results['legacy'].astype(np.float32),
+                          results['filtered'])
+
+
+def make_tokens(path, n_videos, seed=0):
+    """Write a synthetic token corpus, with sponsor segments of 30-300 words"""
+    rng = np.random.default_rng(seed)
+
+    def records():
+        for v in range(n_videos):
+            n = int(np.clip(rng.lognormal(7.5, 0.8), 10, 30000))
+            labels = np.zeros(n, np.uint8)
+            for start in rng.integers(0, n, rng.integers(0, 3)):
+                labels[start:start + rng.integers(30, 300)] = 1
+            yield f'v{v}', {'token': rng.integers(1, 10000, n),
+                            'label': labels}
+
+    write_atomic(path, TOKEN_COLUMNS, records())
+
+
+def legacy_pad(sequences, max_len):
+    """pad_sequences(sequences, padding='post', maxlen=max_len)"""
+    padded = np.zeros((len(sequences), max_len), np.int32)
+    for i, sequence in enumerate(sequences):
+        padded[i, :len(sequence)] = sequence
+    return padded
+
+
+def legacy_reshape_data(x, y, max_len, overlap):
+    """The trainer's reshape_data before the streaming input"""
+    x_shaped = []
+    y_shaped = []
+    for i in range(len(x)):
+        splits = get_split_index(len(x[i]), max_len, overlap)
+        x_shaped.extend([np.array(x[i][a:b], dtype='float64')
+                         for a, b in splits])
+        y_shaped.extend([np.array(y[i][a:b], dtype='float64')
+                         for a, b in splits])
+    return legacy_pad(x_shaped, max_len), legacy_pad(y_shaped, max_len)
+
+
+def legacy_inputs(path):
+    """The trainer's in-memory arrays, as passed to model.fit"""
+    corpus = Corpus(path)
+    # lists of token ids, as texts_to_sequences returns
+    x = [tokens.tolist() for tokens in corpus.arrays('token')]
+    y = [labels.tolist() for labels in corpus.arrays('label')]
+    x, y = legacy_reshape_data(x, y, MAX_LEN, WINDOW_OVERLAP)
+    weight = (y.shape[0] * y.shape[1]) / y.sum()
+    sample_weight = y * weight + 1
+    y_categorical = np.eye(2, dtype=np.float32)[y]
+    return (len(x), int(x.sum()), int(y_categorical[..., 1].sum()),
+            round(float(sample_weight.sum()), 3))
+
+
+def streamed_inputs(path, batch_size=32):
+    """Batches as the trainer's tf.data pipeline builds them, in numpy"""
+    stream = WindowStream(path, np.arange(len(Corpus(path))))
+    weight = len(stream) * MAX_LEN / stream.positives()
+    n_windows = x_sum = positives = 0
+    weight_sum = 0.0
+    windows = stream()
+    while True:
+        batch = list(islice(windows, batch_size))
+        if not batch:
+            break
+        x = np.stack([x for x, _ in batch])
+        y = np.stack([y for _, y in batch])
+        y_categorical = np.eye(2, dtype=np.float32)[y]
+        sample_weight = y.astype(np.float32) * weight + 1
+        n_windows += len(x)
+        x_sum += int(x.sum(dtype=np.int64))
+        positives += int(y_categorical[..., 1].sum())
+        weight_sum += float(sample_weight.sum(dtype=np.float64))
+    return n_windows, x_sum, positives, round(weight_sum, 3)
+
+
+def bench_dataset(videos_list, seed):
+    print(f'{"videos":>7} {"windows":>8} {"input":>9} {"seconds":>8} '
+          f'{"windows/s":>10} {"peak MiB":>9}')
+    for n_videos in videos_list:
+        os.makedirs(SYNTHETIC_DIR, exist_ok=True)
+        path = os.path.join(SYNTHETIC_DIR, f'tokens_{n_videos}_{seed}')
+        if not os.path.isdir(path):
+            make_tokens(path, n_videos, seed)
+
+        # the streamed windows are those of reshape_data, in order
+        corpus = Corpus(path)
+        first = min(200, n_videos)
+        x, y = legacy_reshape_data(corpus.arrays('token')[:first],
+                                   corpus.arrays('label')[:first],
+                                   MAX_LEN, WINDOW_OVERLAP)
+        windows = list(WindowStream(path, np.arange(first))())
+        assert np.array_equal(x, np.stack([x for x, _ in windows]))
+        assert np.array_equal(y, np.stack([y for _, y in windows]))
+
+        results = []
+        for name, fn in [('in-memory', legacy_inputs),
+                         ('streamed', streamed_inputs)]:
+            result, t, peak = measure(fn, path)
+            results.append(result)
+            print(f'{n_videos:>7} {result[0]:>8} {name:>9} {t:>8.1f} '
+                  f'{result[0] / t:>10.0f} {peak:>9.0f}')
+        # same windows, labels & weights, up to float32 rounding
+        assert results[0][:3] == results[1][:3]
+        assert abs(results[0][3] - results[1][3]) < 1e-5 * results[0][3]
+
+
+def reshape_lists(path, reshape):
+    """Window the videos of a token corpus, from the lists
+    texts_to_sequences returns, as the quantizer does"""
+    corpus = Corpus(path)
+    x = [tokens.tolist() for tokens in corpus.arrays('token')]
+    y = [labels.tolist() for labels in corpus.arrays('label')]
+    before = peak_rss()
+    x, y = reshape(x, y, MAX_LEN, WINDOW_OVERLAP)
+    return (len(x), (x.nbytes + y.nbytes) / 2 ** 20,
+            (peak_rss() - before) / 2 ** 10)
+
+
+def bench_reshape(videos_list, seed):
+    print(f'{"videos":>7} {"windows":>8} {"reshape":>8} {"seconds":>8} '
+          f'{"output MiB":>11} {"peak MiB":>9}')
+    for n_videos in videos_list:
+        os.makedirs(SYNTHETIC_DIR, exist_ok=True)
+        path = os.path.join(SYNTHETIC_DIR, f'tokens_{n_videos}_{seed}')
+        if not os.path.isdir(path):
+            make_tokens(path, n_videos, seed)
+
+        # same windows as before, and as streamed
+        corpus = Corpus(path)
+        first = min(200, n_videos)
+        tokens = corpus.arrays('token')[:first]
+        labels = corpus.arrays('label')[:first]
+        x, y = reshape_data(tokens, labels, MAX_LEN, WINDOW_OVERLAP)
+        legacy_x, legacy_y = legacy_reshape_data(tokens, labels, MAX_LEN,
+                                                 WINDOW_OVERLAP)
+        assert np.array_equal(x, legacy_x) and np.array_equal(y, legacy_y)
+        windows = list(WindowStream(path, np.arange(first))())
+        assert np.array_equal(x, np.stack([x for x, _ in windows]))
+        # misaligned videos are dropped, the others windowed as before
+        labels[1] = labels[1][:-1]
+        x, y = reshape_data(tokens, labels, MAX_LEN, WINDOW_OVERLAP)
+        n_windows = len(get_split_index(len(tokens[1]), MAX_LEN,
+                                        WINDOW_OVERLAP))
+        assert len(x) == len(legacy_x) - n_windows
+
+        for name, fn in [('legacy', legacy_reshape_data),
+                         ('compact', reshape_data)]:
+            (n, output, peak), t, _ = measure(reshape_lists, path, fn)
+            print(f'{n_videos:>7} {n:>8} {name:>8} {t:>8.1f} '
+                  f'{output:>11.0f} {peak:>9.0f}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    timestamps = subparsers.add_parser(
+        'timestamps', help='legacy vs chunked sponsorTimes.csv reader')
+    timestamps.add_argument('--rows', type=int, default=2000000)
+    timestamps.add_argument('--seed', type=int, default=0)
+
+    labeller = subparsers.add_parser(
+        'labeller', help='legacy vs vectorized sponsor labelling')
+    labeller.add_argument('--snippets', type=int, nargs='+',
+                          default=[500, 5000, 50000])
+    labeller.add_argument('--segments', type=int, nargs='+',
+                          default=[2, 20, 200])
+
+    cleaner = subparsers.add_parser(
+        'cleaner', help='legacy vs parallel text & label building')
+    cleaner.add_argument('--videos', type=int, default=100000)
+    cleaner.add_argument('--workers', type=int, nargs='+',
+                         default=[1, os.cpu_count()])
+    cleaner.add_argument('--seed', type=int, default=0)
+
+    corpus = subparsers.add_parser(
+        'corpus', help='load time & memory of the JSON files vs corpora')
+    corpus.add_argument('--videos', type=int, default=100000)
+    corpus.add_argument('--seed', type=int, default=0)
+
+    vectors = subparsers.add_parser(
+        'vectors', help='full vs vocabulary-filtered word vector loading')
+    vectors.add_argument('--words', type=int, default=1000000)
+    vectors.add_argument('--vocabulary', type=int, default=12000)
+    vectors.add_argument('--seed', type=int, default=0)
+
+    dataset = subparsers.add_parser(
+        'dataset', help='in-memory vs streamed trainer input')
+    dataset.add_argument('--videos', type=int, nargs='+', default=[1000, 4000])
+    dataset.add_argument('--seed', type=int, default=0)
+
+    reshape = subparsers.add_parser(
+        'reshape', help='float64 vs compact in-memory windowing')
+    reshape.add_argument('--videos', type=int, nargs='+', default=[1000, 4000])
+    reshape.add_argument('--seed', type=int, default=0)
+
+    args = parser.parse_args()
+    if args.benchmark == 'timestamps':
+        bench_timestamps(args.rows, args.seed)
+    elif args.benchmark == 'labeller':
+        bench_labeller(args.snippets, args.segments)
+    elif args.benchmark == 'cleaner':
+        bench_cleaner(args.videos, args.workers, args.seed)
+    elif args.benchmark == 'corpus':
+        bench_corpus(args.videos, args.seed)
+    elif args.benchmark == 'vectors':
+        bench_vectors(args.words, args.vocabulary, args.seed)
+    elif args.benchmark == 'dataset':
+        bench_dataset(args.videos, args.seed)
+    elif args.benchmark == 'reshape':
+        bench_reshape(args.videos, args.seed)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+"""
+Clean the scraped transcripts into the text & per-token labels the model is
+trained on, in a pool of processes. Workers read the raw corpus memory-mapped
+and the results are streamed to the text & labels corpus.
+"""
+import os
+import re
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from .corpus import TEXT_LABEL_COLUMNS, Corpus, write_atomic
+
+# replaced by spaces, as is `;<`, while lone `;` and `<` are kept
+PUNCTUATIONS = '!"#$%&()*+,-./:=>?@[\\]^_`{|}~\t\n'
+TABLE = bytes.maketrans(PUNCTUATIONS.encode(), b' ' * len(PUNCTUATIONS))
+SPACES = re.compile("  +")
+CHUNK_SIZE = 256  # videos per task
+
+
+def strip_punctuations(s):
+    """
+    Drop non-breaking spaces, replace runs of punctuation with a space and
+    strip. Same as the regex the preprocessor used before,
+    `(!|"|#|...|:|;\\<|=|...|\\t|\\n)+`, but with a translation table
+    """
+    s = (s.replace(u'\xa0', u'').replace(';<', ' ')
+         .encode('utf-8', 'surrogatepass')
+         .translate(TABLE)
+         .decode('utf-8', 'surrogatepass'))
+    return SPACES.sub(" ", s).strip()
+
+
+def strip_all(texts):
+    """Same as strip_punctuations on each text, in one pass for all"""
+    # NUL is neither replaced nor stripped, so no run of punctuation or
+    # spaces crosses it
+    joined = '\0'.join(texts)
+    if joined.count('\0') != len(texts) - 1:
+        return [strip_punctuations(s) for s in texts]
+    return [s.strip() for s in strip_punctuations(joined).split('\0')]
+
+
+def text_labels(texts, labels):
+    """
+    Return the cleaned text of a video from the texts of its snippets, and
+    the label of each of its tokens. A snippet of n words gives n labels
+    """
+    texts = strip_all(texts)
+    counts = np.fromiter((s.count(' ') + 1 for s in texts), np.int64,
+                         len(texts))
+    return ' '.join(texts), np.repeat(np.asarray(labels, np.uint8), counts)
+
+
+_corpora = {}
+
+
+def _clean_records(path, start, stop):
+    """Clean records start to stop of a raw corpus, in a worker process"""
+    corpus = _corpora.get(path)
+    if corpus is None:
+        corpus = _corpora[path] = Corpus(path)
+    texts = corpus.strings('text', start, stop)
+    text_offsets = corpus.offsets('text') - corpus.offsets('text')[start]
+    errors = np.diff(corpus.offsets('error'))
+    labels, label_offsets = corpus.values('label'), corpus.offsets('label')
+
+    cleaned = []
+    for i in range(start, stop):
+        if errors[i]:
+            continue
+        text, token_labels = text_labels(
+            texts[text_offsets[i]:text_offsets[i + 1]],
+            labels[label_offsets[i]:label_offsets[i + 1]])
+        cleaned.append((corpus.keys[i], text, token_labels))
+    return cleaned
+
+
+def _cleaned(raw_path, workers, chunk_size):
+    n = len(Corpus(raw_path))
+    starts = iter(range(0, n, chunk_size))
+    pending = deque()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        while True:
+            # keep a bounded number of chunks in flight, written in order
+            for start in starts:
+                pending.append(executor.submit(
+                    _clean_records, raw_path, start, min(n, start + chunk_size)))
+                if len(pending) >= 2 * workers:
+                    break
+            if not pending:
+                break
+
+            for key, text, labels in pending.popleft().result():
+                yield key, {'text': [text], 'label': labels}
+
+
+def write_text_labels(raw_path, path, workers=None, chunk_size=CHUNK_SIZE):
+    """
+    Clean the transcripts of the raw corpus in `workers` processes, and write
+    the text & labels corpus to path, which only appears once complete.
+    Videos without a transcript are left out. Returns the number of videos
+    written
+    """
+    return write_atomic(path, TEXT_LABEL_COLUMNS,
+                        _cleaned(raw_path, workers or os.cpu_count(),
+                                 chunk_size))
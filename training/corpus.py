@@ -0,0 +1,358 @@
+"""
+Columnar storage for the data handed from one stage of the pipeline to the
+next, in place of nested JSON. A corpus is a directory of flat binary files,
+one per column, holding the values of all records (videos) one after the
+other:
+
+    meta.json            column names & dtypes
+    index.bin            int64, the end of each record in every file below
+    key.bin, key.ends    the record keys (video ids), as for a str column
+    <column>.bin         values of a numeric column, e.g. uint8 labels
+    <column>.bin, .ends  UTF-8 bytes & the int64 byte end of each string of
+                         a str column
+
+Files are memory-mapped when read: opening a corpus takes no time nor memory
+until values are used, and processes share the pages. Records are only
+appended, and a record is complete once its row in index.bin is written, so
+a writer reopening a corpus after a crash truncates every file to the last
+complete record.
+
+To convert the JSON files of earlier versions, run in the training directory:
+
+    python corpus.py
+"""
+import json
+import os
+import shutil
+
+import numpy as np
+
+from .logger import get_console_log, get_logger
+
+work_dir = os.getcwd()
+data_dir = os.path.join(work_dir, 'data')
+if not os.path.isdir(data_dir):
+    os.makedirs(data_dir)
+
+# corpora written by the scraper & preprocessor
+TIMESTAMPS = os.path.join(data_dir, 'timestamps')
+RAW = os.path.join(data_dir, 'raw')
+TEXT_LABELS = os.path.join(data_dir, 'text_labels')
+# JSON files of earlier versions
+TIMESTAMPS_JSON = os.path.join(data_dir, 'id_timestamp.json')
+RAW_JSON = os.path.join(data_dir, 'raw.json')
+RAW_JSONL = os.path.join(data_dir, 'raw.jsonl')
+TEXT_LABELS_JSON = os.path.join(data_dir, 'text_labels.json')
+
+STR = 'str'
+KEY = 'key'
+INDEX = 'index.bin'
+META = 'meta.json'
+
+# [start, end] of the sponsor segments of each video
+TIMESTAMP_COLUMNS = {'start': np.float64, 'end': np.float64}
+# labelled transcript snippets, or the error class if there is no transcript
+RAW_COLUMNS = {'text': STR, 'start': np.float64, 'end': np.float64,
+               'label': np.uint8, 'error': STR}
+# cleaned text of a video, and the label of each of its tokens
+TEXT_LABEL_COLUMNS = {'text': STR, 'label': np.uint8}
+# token ids of a video, by the tokenizer, and the label of each word
+TOKEN_COLUMNS = {'token': np.int32, 'label': np.uint8}
+
+logger = get_logger('main', 'corpus.log')
+
+
+def _files(columns):
+    """Return the name & dtype of every file of a corpus with these columns"""
+    files = []
+    for name, dtype in [(KEY, STR)] + list(columns.items()):
+        if dtype == STR:
+            files += [(f'{name}.bin', np.dtype(np.uint8)),
+                      (f'{name}.ends', np.dtype(np.int64))]
+        else:
+            files.append((f'{name}.bin', np.dtype(dtype)))
+    return files
+
+
+def _read_meta(path):
+    with open(os.path.join(path, META), 'r') as f:
+        return json.load(f)['columns']
+
+
+def _complete_rows(path, n_files):
+    """Return the rows of index.bin, without a torn last row"""
+    index = os.path.join(path, INDEX)
+    n = os.path.getsize(index) // (8 * n_files)
+    return np.fromfile(index, np.int64, n * n_files).reshape(n, n_files)
+
+
+class CorpusWriter(object):
+    """
+    Append records to a corpus, creating it if needed. Columns map names to
+    a numpy dtype, or STR for a list of strings per record. Records are
+    durable once flushed
+    """
+
+    def __init__(self, path, columns):
+        columns = {name: dtype if dtype == STR else np.dtype(dtype).str
+                   for name, dtype in columns.items()}
+        os.makedirs(path, exist_ok=True)
+        if os.path.isfile(os.path.join(path, META)):
+            if _read_meta(path) != columns:
+                raise ValueError(f'{path} has other columns than {columns}')
+        else:
+            with open(os.path.join(path, META + '.tmp'), 'w') as f:
+                json.dump({'columns': columns}, f)
+            os.replace(os.path.join(path, META + '.tmp'),
+                       os.path.join(path, META))
+            open(os.path.join(path, INDEX), 'ab').close()
+
+        self.path = path
+        self.columns = columns
+        self.files = _files(columns)
+        self.ends = self._recover()
+        self.pending = []
+        self.handles = [open(os.path.join(path, name), 'ab')
+                        for name, _ in self.files]
+        self.index = open(os.path.join(path, INDEX), 'ab')
+
+    def _recover(self):
+        """Truncate the files to the last complete record, return its ends"""
+        rows = _complete_rows(self.path, len(self.files))
+        ends = rows[-1] if len(rows) else np.zeros(len(self.files), np.int64)
+        for end, (name, dtype) in zip(ends.tolist(), self.files):
+            filename = os.path.join(self.path, name)
+            size = end * dtype.itemsize
+            if not os.path.isfile(filename):
+                open(filename, 'ab').close()
+            if os.path.getsize(filename) > size:
+                logger.info(f'Drop an incomplete record from {filename}')
+                os.truncate(filename, size)
+        os.truncate(os.path.join(self.path, INDEX), rows.nbytes)
+        return ends.copy()
+
+    def append(self, key, **values):
+        """Append a record: its key, and a sequence of values per column"""
+        i = 0
+        for name, dtype in [(KEY, STR)] + list(self.columns.items()):
+            value = [key] if name == KEY else values[name]
+            if dtype == STR:
+                encoded = [s.encode('utf-8', 'surrogatepass') for s in value]
+                lengths = np.fromiter(map(len, encoded), np.int64, len(encoded))
+                self.handles[i].write(b''.join(encoded))
+                self.handles[i + 1].write(
+                    (self.ends[i] + np.cumsum(lengths)).tobytes())
+                self.ends[i] += lengths.sum()
+                self.ends[i + 1] += len(encoded)
+                i += 2
+            else:
+                array = np.ascontiguousarray(value, dtype=dtype)
+                self.handles[i].write(array.tobytes())
+                self.ends[i] += len(array)
+                i += 1
+        self.pending.append(self.ends.tobytes())
+
+    def flush(self):
+        """Write the pending records, values first, then their index rows"""
+        for handle in self.handles:
+            handle.flush()
+        self.index.write(b''.join(self.pending))
+        self.index.flush()
+        self.pending = []
+
+    def close(self):
+        self.flush()
+        for handle in self.handles + [self.index]:
+            handle.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class Corpus(object):
+    """
+    Read a corpus, memory-mapped. `keys` holds the record keys, `values(name)`
+    the values of all records of a numeric column, with record i at
+    `offsets(name)[i]:offsets(name)[i + 1]`
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.columns = _read_meta(path)
+        self.files = _files(self.columns)
+        rows = _complete_rows(path, len(self.files))
+        self._offsets = np.concatenate(
+            [np.zeros((1, len(self.files)), np.int64), rows])
+        self._maps = {}
+        self.keys = self.strings(KEY)
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def _position(self, filename):
+        return [name for name, _ in self.files].index(filename)
+
+    def _map(self, filename):
+        """Memory-map a file, up to the end of the last complete record"""
+        if filename not in self._maps:
+            i = self._position(filename)
+            dtype, count = self.files[i][1], int(self._offsets[-1, i])
+            self._maps[filename] = (np.memmap(
+                os.path.join(self.path, filename), dtype, 'r', shape=(count,))
+                if count else np.empty(0, dtype))
+        return self._maps[filename]
+
+    def offsets(self, name):
+        """Record boundaries of a column, in values (strings for str columns)"""
+        suffix = '.ends' if self.columns.get(name, STR) == STR else '.bin'
+        return self._offsets[:, self._position(name + suffix)]
+
+    def values(self, name):
+        return self._map(f'{name}.bin')
+
+    def arrays(self, name):
+        """Return the values of a numeric column, one view per record"""
+        values, offsets = self.values(name), self.offsets(name).tolist()
+        return [values[start:end] for start, end
+                in zip(offsets[:-1], offsets[1:])]
+
+    def strings(self, name, start=0, stop=None):
+        """Decode the strings of a str column, of records start to stop"""
+        offsets = self.offsets(name)
+        stop = len(self) if stop is None else stop
+        first, last = int(offsets[start]), int(offsets[stop])
+        all_ends = self._map(f'{name}.ends')
+        begin = int(all_ends[first - 1]) if first else 0
+        ends = (all_ends[first:last] - begin).tolist()
+        data = self._map(f'{name}.bin')[begin:begin + (ends[-1] if ends else 0)]
+        data = data.tobytes()
+        return [data[a:b].decode('utf-8', 'surrogatepass')
+                for a, b in zip([0] + ends[:-1], ends)]
+
+    def record(self, i):
+        """Return the values of record i, by column"""
+        record = {}
+        for name, dtype in self.columns.items():
+            if dtype == STR:
+                record[name] = self.strings(name, i, i + 1)
+            else:
+                offsets = self.offsets(name)
+                record[name] = self.values(name)[offsets[i]:offsets[i + 1]]
+        return record
+
+    def __getitem__(self, i):
+        return self.record(i)
+
+    def __iter__(self):
+        return (self.record(i) for i in range(len(self)))
+
+
+def write_atomic(path, columns, records):
+    """
+    Write (key, values) records to a new corpus at path, which only appears
+    once complete. Replaces the corpus at path if any
+    """
+    tmp_path = path + '.tmp'
+    if os.path.isdir(tmp_path):
+        shutil.rmtree(tmp_path)
+    n = 0
+    with CorpusWriter(tmp_path, columns) as writer:
+        for key, values in records:
+            writer.append(key, **values)
+            n += 1
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    os.replace(tmp_path, path)
+    return n
+
+
+def raw_values(columns):
+    """Raw record values from the columns of a transcript DataFrame"""
+    return {'text': list(columns['text']), 'start': list(columns['start']),
+            'end': list(columns['end']), 'label': list(columns['label']),
+            'error': []}
+
+
+def error_values(error):
+    """Raw record values of a video without a transcript"""
+    return {'text': [], 'start': [], 'end': [], 'label': [], 'error': [error]}
+
+
+def iter_legacy_raw(raw_json=RAW_JSON, raw_jsonl=RAW_JSONL):
+    """
+    Yield the video id & raw values of the videos in raw.json & raw.jsonl,
+    once per video
+    """
+    seen = set()
+    if raw_json and os.path.isfile(raw_json):
+        with open(raw_json, 'r') as f:
+            data = json.loads(f.read())
+        for vid, transcript in data.items():
+            seen.add(vid)
+            yield vid, raw_values(
+                {k: v.values() for k, v in json.loads(transcript).items()})
+        del data
+
+    if os.path.isfile(raw_jsonl):
+        with open(raw_jsonl, 'r') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # a line torn by a crash
+                    continue
+                if record['vid'] in seen:
+                    continue
+                seen.add(record['vid'])
+                if 'transcript' in record:
+                    yield record['vid'], raw_values(
+                        {k: v.values() for k, v
+                         in json.loads(record['transcript']).items()})
+                else:
+                    yield record['vid'], error_values(record['error'])
+
+
+def iter_legacy_timestamps(path=TIMESTAMPS_JSON):
+    with open(path, 'r') as f:
+        data = json.loads(json.load(f))
+    for i, vid in data['videoID'].items():
+        segments = np.array(data['time'][i], np.float64).reshape(-1, 2)
+        yield vid, {'start': segments[:, 0], 'end': segments[:, 1]}
+
+
+def iter_legacy_text_labels(path=TEXT_LABELS_JSON):
+    """The videos of text_labels.json, which has no video ids"""
+    with open(path, 'r') as f:
+        data = json.load(f)
+    for text, labels in zip(data['text'], data['labels']):
+        yield '', {'text': [text], 'label': labels}
+
+
+def convert():
+    """Convert the JSON files of earlier versions to corpora, once"""
+    for name, path, columns, legacy_paths, records in [
+            ('timestamps', TIMESTAMPS, TIMESTAMP_COLUMNS, [TIMESTAMPS_JSON],
+             iter_legacy_timestamps),
+            ('transcripts', RAW, RAW_COLUMNS, [RAW_JSON, RAW_JSONL],
+             iter_legacy_raw),
+            ('text & labels', TEXT_LABELS, TEXT_LABEL_COLUMNS,
+             [TEXT_LABELS_JSON], iter_legacy_text_labels)]:
+        if os.path.isdir(path):
+            logger.info(f'Found {path}, skip')
+        elif any(os.path.isfile(p) for p in legacy_paths):
+            logger.info(f'Convert {name} to {path}...')
+            n = write_atomic(path, columns, records())
+            logger.info(f'Done, {n} videos')
+
+
+def main():
+    _ = get_console_log()
+    convert()
+    logger.info('EXIT 0')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,180 @@
+"""
+Streaming input of the trainer. Tokenized videos are read from the token
+corpus, memory-mapped, and cut into windows on the fly, so memory stays flat
+however large the corpus is. The trainer wraps `WindowStream` in a tf.data
+pipeline that batches the windows, builds their sample weights and prefetches
+on background threads. `reshape_data` cuts in-memory sequences into the same
+windows, all at once.
+"""
+import os
+
+import numpy as np
+
+from .corpus import TOKEN_COLUMNS, Corpus, data_dir, write_atomic
+from .logger import get_logger
+from .vectors import tokenizer_hash
+
+MAX_LEN = 3000
+OVERLAP = 800
+
+logger = get_logger('main', 'dataset.log')
+
+
+def tokens_path(tokenizer_path):
+    """The token corpus of a tokenizer, keyed by its hash"""
+    return os.path.join(data_dir, f'tokens_{tokenizer_hash(tokenizer_path)}')
+
+
+def write_tokens(text_labels_path, path, tokenizer, chunk_size=1000):
+    """Tokenize the texts of a text & labels corpus, chunk by chunk"""
+    corpus = Corpus(text_labels_path)
+    labels = corpus.arrays('label')
+
+    def records():
+        for start in range(0, len(corpus), chunk_size):
+            stop = min(len(corpus), start + chunk_size)
+            sequences = tokenizer.texts_to_sequences(
+                corpus.strings('text', start, stop))
+            for i, tokens in zip(range(start, stop), sequences):
+                yield corpus.keys[i], {'token': tokens, 'label': labels[i]}
+
+    return write_atomic(path, TOKEN_COLUMNS, records())
+
+
+def get_split_index(len_arr, max_len, overlap):
+    if len_arr <= max_len:
+        return [[0, len_arr]]
+    else:
+        splits = [[0, max_len]]
+        i = 1
+        while True:
+            if ((max_len-overlap)*i+max_len) >= len_arr:
+                break
+            else:
+                splits.append(
+                    [(max_len-overlap)*i, ((max_len-overlap)*i+max_len)])
+            i += 1
+        splits.append([(max_len-overlap)*i, len_arr])
+
+        return splits
+
+
+def reshape_data(x, y, max_len=MAX_LEN, overlap=OVERLAP):
+    """
+    Splice x and y sequences into chunks of max_len with overlap. Return the
+    windows padded with zeros, as int32 tokens & uint8 labels. Both arrays are
+    allocated once and filled in place, full windows by strided copies of
+    each video. Videos whose token & label counts differ are dropped
+    """
+    if len(x) != len(y):
+        raise ValueError(f'{len(x)} token sequences for {len(y)} label ones')
+    videos = []
+    dropped = 0
+    for tokens, labels in zip(x, y):
+        if len(tokens) != len(labels):
+            dropped += 1
+            continue
+        videos.append((tokens, labels,
+                       get_split_index(len(tokens), max_len, overlap)))
+
+    n_windows = sum(len(splits) for _, _, splits in videos)
+    x_shaped = np.zeros((n_windows, max_len), np.int32)
+    y_shaped = np.zeros((n_windows, max_len), np.uint8)
+    row = 0
+    for tokens, labels, splits in videos:
+        tokens = np.asarray(tokens, dtype=np.int32)
+        labels = np.asarray(labels, dtype=np.uint8)
+        # the first len(splits) - 1 windows are full, max_len - overlap apart
+        n_full = len(splits) - 1
+        if n_full:
+            step = max_len - overlap
+            x_shaped[row:row + n_full] = np.lib.stride_tricks.as_strided(
+                tokens, (n_full, max_len), (step * tokens.strides[0],
+                                            tokens.strides[0]))
+            y_shaped[row:row + n_full] = np.lib.stride_tricks.as_strided(
+                labels, (n_full, max_len), (step * labels.strides[0],
+                                            labels.strides[0]))
+            row += n_full
+        start, end = splits[-1]
+        x_shaped[row, :end - start] = tokens[start:end]
+        y_shaped[row, :end - start] = labels[start:end]
+        row += 1
+
+    if dropped:
+        logger.warning(f'Dropped {dropped} videos with misaligned tokens '
+                       'and labels')
+    logger.info(f'{n_windows} windows of {len(videos)} videos, '
+                f'{(x_shaped.nbytes + y_shaped.nbytes) / 2 ** 20:.1f} MiB')
+    return x_shaped, y_shaped
+
+
+class WindowStream(object):
+    """
+    The windows of some videos of a token corpus, as (tokens, labels) pairs
+    padded to max_len: the same windows `reshape_data` gives, one at a time.
+    Calling it starts an epoch, with the videos in a new order if shuffle.
+    Videos whose token & label counts differ are left out, as `dropped`.
+
+    # Arguments
+        path: path of the token corpus.
+        videos: indices of the videos in the corpus.
+    """
+
+    def __init__(self, path, videos, max_len=MAX_LEN, overlap=OVERLAP,
+                 shuffle=False, seed=0):
+        corpus = Corpus(path)
+        self.tokens, self.labels = corpus.values('token'), corpus.values('label')
+        self.token_offsets = corpus.offsets('token')
+        self.label_offsets = corpus.offsets('label')
+        videos = np.asarray(videos, dtype=np.int64)
+        aligned = (np.diff(self.token_offsets)[videos] ==
+                   np.diff(self.label_offsets)[videos])
+        self.videos = videos[aligned]
+        self.dropped = int(len(videos) - aligned.sum())
+        self.max_len = max_len
+        self.overlap = overlap
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+
+    def splits(self, video):
+        """The [start, end) of the windows of a video"""
+        length = self.token_offsets[video + 1] - self.token_offsets[video]
+        return get_split_index(int(length), self.max_len, self.overlap)
+
+    def __len__(self):
+        """Number of windows in an epoch"""
+        return sum(len(self.splits(video)) for video in self.videos.tolist())
+
+    def positives(self):
+        """Number of sponsor labels in all windows, overlaps counted twice"""
+        total = 0
+        for video in self.videos.tolist():
+            labels = self.labels[self.label_offsets[video]:
+                                 self.label_offsets[video + 1]]
+            for start, end in self.splits(video):
+                total += int(labels[start:end].sum())
+        return total
+
+    def __call__(self):
+        videos = self.videos
+        if self.shuffle:
+            rng = np.random.default_rng(self.seed + self.epoch)
+            videos = rng.permutation(videos)
+        self.epoch += 1
+        return self._windows(videos)
+
+    def _windows(self, videos):
+        for video in videos.tolist():
+            tokens = self.tokens[self.token_offsets[video]:
+                                 self.token_offsets[video + 1]]
+            labels = self.labels[self.label_offsets[video]:
+                                 self.label_offsets[video + 1]]
+            for start, end in self.splits(video):
+                x = np.zeros(self.max_len, np.int32)
+                y = np.zeros(self.max_len, np.uint8)
+                window = tokens[start:end]
+                x[:len(window)] = window
+                window = labels[start:end]
+                y[:len(window)] = window
+                yield x, y
@@ -0,0 +1,50 @@
+import argparse
+import os
+
+import tensorflow as tf
+import tf2onnx
+from tensorflow.keras.models import load_model
+
+from .logger import get_console_log, get_logger
+from .trainer import MAX_LEN, MODEL_FILE, build_model, model_dir
+
+ONNX_MODEL = os.path.join(model_dir, 'model.onnx')
+INPUT_NAME = 'embedding_3_input'  # the input name the backend feeds
+OPSET = 13
+
+logger = get_logger('main', 'exporter.log')
+_ = get_console_log()
+
+
+def export_onnx(dynamic=True):
+    """
+    Convert the trained Keras model to ONNX. With dynamic, the time axis
+    of the input is left unset so the backend can run shorter windows
+    """
+    trained = load_model(MODEL_FILE)
+    if dynamic:
+        # rebuild without a fixed input length and copy the trained weights
+        model = build_model(input_length=None)
+        model.set_weights(trained.get_weights())
+    else:
+        model = trained
+
+    spec = (tf.TensorSpec((None, None if dynamic else MAX_LEN), tf.float32,
+                          name=INPUT_NAME),)
+    tf2onnx.convert.from_keras(model, input_signature=spec, opset=OPSET,
+                               output_path=ONNX_MODEL)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Export the model to ONNX')
+    parser.add_argument('--fixed', action='store_true',
+                        help=f'fix the time axis to {MAX_LEN}')
+    args = parser.parse_args()
+
+    logger.info('Export model to ONNX...')
+    export_onnx(dynamic=not args.fixed)
+    logger.info(f'Done, dump to {ONNX_MODEL}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,49 @@
+"""
+Sponsor labels of transcript snippets from the time ranges of sponsor
+segments, for all segments at once. Used by the scraper, and usable by any
+tool that needs to label snippets with other segments or semantics.
+"""
+import numpy as np
+
+# snippet lies entirely within a segment, what the scraper always labelled
+CONTAIN = 'contain'
+# snippet shares any time with a segment
+OVERLAP = 'overlap'
+
+
+def label_snippets(starts, ends, segments, mode=CONTAIN):
+    """
+    Return a uint8 array, 1 for each snippet [start, end] in a segment.
+
+    With segments sorted by start, the latest end of the segments starting
+    before a time is a running maximum, so a snippet is checked against all
+    segments with one binary search instead of a pass per segment.
+
+    # Arguments
+        starts, ends: start & end time of each snippet.
+        segments: [start, end] of each sponsor segment, in any order,
+            possibly overlapping.
+        mode: CONTAIN to label snippets with start >= segment start and
+            end <= segment end, OVERLAP to label snippets with
+            start < segment end and end > segment start.
+    """
+    starts = np.asarray(starts, dtype=np.float64)
+    ends = np.asarray(ends, dtype=np.float64)
+    segments = np.asarray(segments, dtype=np.float64).reshape(-1, 2)
+    if len(segments) == 0:
+        return np.zeros(len(starts), dtype=np.uint8)
+
+    segments = segments[np.argsort(segments[:, 0], kind='stable')]
+    latest_end = np.maximum.accumulate(segments[:, 1])
+    if mode == CONTAIN:
+        # last segment with start <= snippet start
+        i = np.searchsorted(segments[:, 0], starts, 'right') - 1
+        labelled = (i >= 0) & (latest_end[i.clip(0)] >= ends)
+    elif mode == OVERLAP:
+        # last segment with start < snippet end
+        i = np.searchsorted(segments[:, 0], ends, 'left') - 1
+        labelled = (i >= 0) & (latest_end[i.clip(0)] > starts)
+    else:
+        raise ValueError(f'Unknown labelling mode {mode}')
+
+    return labelled.astype(np.uint8)
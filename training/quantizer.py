@@ -0,0 +1,140 @@
+import argparse
+import json
+import os
+from time import perf_counter
+
+import numpy as np
+import onnxruntime as ort
+from onnxruntime.quantization import QuantType, quantize_dynamic
+from sklearn.model_selection import train_test_split
+from tensorflow.keras.preprocessing.text import tokenizer_from_json
+
+from .corpus import TEXT_LABELS, Corpus
+from .dataset import MAX_LEN, OVERLAP, reshape_data
+from .exporter import ONNX_MODEL
+from .logger import get_console_log, get_logger
+from .trainer import TOKENIZER, model_dir
+
+INT8_MODEL = os.path.join(model_dir, 'model.int8.onnx')
+REPORT = os.path.join(model_dir, 'quantization_report.json')
+# Gather covers the embedding table, LSTM & MatMul the recurrent and dense layers
+QUANTIZED_OPS = ['Gather', 'LSTM', 'MatMul']
+THRESHOLD = 0.5
+
+logger = get_logger('main', 'quantizer.log')
+_ = get_console_log()
+
+
+def quantize():
+    """Dynamically quantize the fp32 model weights to int8"""
+    quantize_dynamic(ONNX_MODEL, INT8_MODEL,
+                     op_types_to_quantize=QUANTIZED_OPS,
+                     weight_type=QuantType.QInt8)
+
+
+def get_test_windows(limit=None):
+    """Window the held-out videos, split the same way as the trainer does"""
+    corpus = Corpus(TEXT_LABELS)
+    with open(TOKENIZER) as f:
+        tokenizer = tokenizer_from_json(json.load(f))
+
+    _, x_test, _, y_test = train_test_split(
+        corpus.strings('text'),
+        corpus.arrays('label'),
+        test_size=0.2,
+        random_state=42,
+        shuffle=True)
+    if limit:
+        x_test, y_test = x_test[:limit], y_test[:limit]
+    x_test = tokenizer.texts_to_sequences(x_test)
+
+    return reshape_data(x_test, y_test, max_len=MAX_LEN, overlap=OVERLAP)
+
+
+def sponsor_segments(mask):
+    """Return [start, end) index pairs of the runs of True in mask"""
+    edges = np.diff(np.concatenate([[0], mask.astype(np.int8), [0]]))
+    return np.stack([np.flatnonzero(edges == 1),
+                     np.flatnonzero(edges == -1)], axis=1)
+
+
+def segment_agreement(reference, candidate, min_iou=0.5):
+    """Fraction of reference segments overlapped by a candidate one with min_iou"""
+    if len(reference) == 0:
+        return None
+    if len(candidate) == 0:
+        return 0.0
+    matched = 0
+    for start, end in reference:
+        inter = (np.minimum(end, candidate[:, 1]) -
+                 np.maximum(start, candidate[:, 0])).clip(0)
+        union = (end - start) + (candidate[:, 1] - candidate[:, 0]) - inter
+        matched += (inter / union).max() >= min_iou
+    return matched / len(reference)
+
+
+def predict(session, X):
+    """Predict window by window, return sponsor probabilities & latencies"""
+    input_name = session.get_inputs()[0].name
+    probs = np.zeros(X.shape, dtype=np.float32)
+    latencies = []
+    for i in range(len(X)):
+        t_start = perf_counter()
+        result = session.run(None, {input_name: X[i:i+1].astype(np.float32)})
+        latencies.append(perf_counter() - t_start)
+        probs[i] = result[0][0, :, 1]
+    return probs, np.array(latencies)
+
+
+def compare(limit=None):
+    X, y = get_test_windows(limit)
+    mask = X != 0
+    models = {'fp32': ONNX_MODEL, 'int8': INT8_MODEL}
+
+    report = {'windows': len(X), 'tokens': int(mask.sum())}
+    probs = {}
+    for name, path in models.items():
+        probs[name], latencies = predict(ort.InferenceSession(path), X)
+        pred = probs[name] >= THRESHOLD
+        report[name] = {
+            'size_mb': os.path.getsize(path) / 2 ** 20,
+            'token_accuracy': float((pred == y.astype(bool))[mask].mean()),
+            'p50_ms': float(np.percentile(latencies, 50) * 1000),
+            'p99_ms': float(np.percentile(latencies, 99) * 1000),
+        }
+
+    fp32, int8 = (probs[name] >= THRESHOLD for name in ['fp32', 'int8'])
+    report['token_agreement'] = float((fp32 == int8)[mask].mean())
+    report['max_abs_diff'] = float(np.abs(probs['fp32'] - probs['int8'])[mask].max())
+    agreements = [segment_agreement(sponsor_segments(a[m]), sponsor_segments(b[m]))
+                  for a, b, m in zip(fp32, int8, mask)]
+    agreements = [a for a in agreements if a is not None]
+    report['segment_agreement'] = (float(np.mean(agreements))
+                                   if agreements else None)
+
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Quantize the ONNX model and compare it with fp32')
+    parser.add_argument('--limit', type=int, default=None,
+                        help='number of held-out videos to evaluate')
+    args = parser.parse_args()
+
+    logger.info('Quantize model...')
+    quantize()
+    logger.info(f'Done, dump to {INT8_MODEL}')
+
+    logger.info('Compare fp32 & int8 models on the held-out set...')
+    report = compare(args.limit)
+    for key, val in report.items():
+        logger.info(f'{key}: {val}')
+    with open(REPORT, 'w') as f:
+        json.dump(report, f, indent=2)
+    logger.info(f'Report dumped to {REPORT}')
+    logger.info('EXIT 0')
+
+
+if __name__ == '__main__':
+    main()
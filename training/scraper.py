@@ -1,112 +1,256 @@
-import json
+import argparse
 import os
+import threading
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from time import monotonic, sleep
+from urllib.request import urlopen
 
+import numpy as np
 import pandas as pd
 from youtube_transcript_api import YouTubeTranscriptApi
 
+from .corpus import (RAW, RAW_COLUMNS, TIMESTAMP_COLUMNS, TIMESTAMPS, Corpus,
+                     CorpusWriter, convert, error_values, raw_values,
+                     write_atomic)
+from .labeller import label_snippets
 from .logger import get_console_log, get_logger
 
-work_dir = os.getcwd()
-data_dir = os.path.join(work_dir, 'data')
-if not os.path.isdir(data_dir):
-    os.makedirs(data_dir)
-TIMESTAMPS = os.path.join(data_dir, 'id_timestamp.json')
-RAW_DATA = os.path.join(data_dir, 'raw.json')
-CHECKPOINT = os.path.join(data_dir, 'checkpoint')
+SPONSOR_TIMES = 'https://sponsor.ajay.app/database/sponsorTimes.csv'
+# only the columns get_timestamps needs, with compact dtypes
+SPONSOR_TIMES_DTYPES = {'videoID': object, 'startTime': np.float64,
+                        'endTime': np.float64, 'votes': np.int32,
+                        'shadowHidden': np.int8}
+MIN_VOTES = 10
+CHUNK_SIZE = 1 << 20
+LANGUAGES = ['en', 'en-US', 'en-GB']
 MAX_RETRIES = 10
+BACKOFF = 30  # seconds, doubled on every consecutive block
+MAX_BACKOFF = 15 * 60
+# YouTube is limiting us, back off and retry the video later
+BLOCKED_ERRORS = {'TooManyRequests', 'RequestBlocked', 'IpBlocked'}
+# the video has no usable transcript, it is recorded and never fetched again
+MISSING_ERRORS = {'NoTranscriptFound', 'TranscriptsDisabled', 'VideoUnavailable',
+                  'VideoUnplayable', 'InvalidVideoId', 'AgeRestricted'}
 
 logger = get_logger('main', 'scraper.log')
 _ = get_console_log()
 
 
-def get_timestamps():
-    """Read the database & dump video id & timestamps to a json file"""
-    if os.path.isfile(TIMESTAMPS):
+def read_timestamps(path=SPONSOR_TIMES, chunksize=CHUNK_SIZE):
+    """
+    Stream the database dump from a URL or local path, chunk by chunk, keeping
+    the segments with enough votes that aren't shadow hidden. Returns the
+    sorted video ids, the bounds of their segments, i.e. those of video i are
+    times[bounds[i]:bounds[i + 1]], and the [start, end] of all segments
+    """
+    vids, times = [], []
+    with (urlopen(path) if path.startswith(('http://', 'https://'))
+          else open(path, 'rb')) as f:
+        for chunk in pd.read_csv(f, usecols=list(SPONSOR_TIMES_DTYPES),
+                                 dtype=SPONSOR_TIMES_DTYPES,
+                                 chunksize=chunksize):
+            chunk = chunk[(chunk.votes >= MIN_VOTES) & (chunk.shadowHidden == 0)]
+            vids.append(chunk.videoID.to_numpy())
+            times.append(chunk[['startTime', 'endTime']].to_numpy())
+    if not vids:
+        return (np.array([], object), np.zeros(1, np.int64),
+                np.zeros((0, 2), np.float64))
+
+    # group the segments by video, in their order in the dump
+    codes, unique_vids = pd.factorize(np.concatenate(vids), sort=True)
+    order = np.argsort(codes, kind='stable')
+    bounds = np.searchsorted(codes[order], np.arange(len(unique_vids) + 1))
+    times = np.concatenate(times)[order]
+
+    return np.asarray(unique_vids, object), bounds, times
+
+
+def get_timestamps(path=SPONSOR_TIMES):
+    """Read the database & write video id & timestamps to a corpus"""
+    if os.path.isdir(TIMESTAMPS):
         logger.info('Timestamp data found, skip')
     else:
-        logger.info('Getting database dump...')
-        raw = pd.read_csv('https://sponsor.ajay.app/database/sponsorTimes.csv')
-        logger.info('Done')
-        df = raw[(raw.votes >= 10) & (raw.shadowHidden == 0)
-                 ][['videoID',  'startTime', 'endTime']]
-        df['time'] = df.apply(lambda x: f'{x.startTime},{x.endTime}', axis=1)
-
-        df_ts = (df
-                 .groupby(['videoID'])['time']
-                 .apply(';'.join)
-                 .apply(lambda s: [[float(y) for y in x] for x in [i.split(',') for i in s.split(';')]])
-                 .reset_index())
-        with open(TIMESTAMPS, 'w') as f:
-            json.dump(df_ts.to_json(), f)
-        logger.info(f'Timestamp info dumped to {TIMESTAMPS}')
-
-
-def get_transcripts():
-    with open(TIMESTAMPS, 'r') as f:
-        json_str = json.loads(f.read())
-        df_ts = pd.read_json(json_str)
-    if os.path.isfile(RAW_DATA):
-        with open(RAW_DATA, 'r') as f:
-            raw = json.loads(f.read())
-    else:
-        raw = dict()
+        logger.info(f'Reading database dump from {path}...')
+        vids, bounds, times = read_timestamps(path)
+        logger.info(f'Done, {len(vids)} videos')
+        starts = np.ascontiguousarray(times[:, 0])
+        ends = np.ascontiguousarray(times[:, 1])
+        write_atomic(TIMESTAMPS, TIMESTAMP_COLUMNS,
+                     ((vid, {'start': starts[start:end], 'end': ends[start:end]})
+                      for vid, start, end in zip(vids.tolist(), bounds[:-1],
+                                                 bounds[1:])))
+        logger.info(f'Timestamp info written to {TIMESTAMPS}')
+
+
+class TokenBucket(object):
+    """
+    Thread-safe token bucket rate limiter, allowing `rate` requests per
+    second on average and bursts of up to `capacity`. On backoff, the rate is
+    halved and all requests pause; it recovers step by step on success
+    """
+
+    def __init__(self, rate, capacity=None, min_rate=0.05):
+        self.max_rate = self.rate = rate
+        self.capacity = capacity or max(1.0, rate)
+        self.min_rate = min_rate
+        self.tokens = self.capacity
+        self.updated = monotonic()
+        self.paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Block until a request is allowed"""
+        while True:
+            with self._lock:
+                now = monotonic()
+                self.tokens = min(self.capacity, self.tokens +
+                                  (now - self.updated) * self.rate)
+                self.updated = now
+                if now < self.paused_until:
+                    delay = self.paused_until - now
+                elif self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                else:
+                    delay = (1 - self.tokens) / self.rate
+            sleep(delay)
+
+    def backoff(self, delay):
+        """Halve the rate and pause all requests for delay seconds"""
+        with self._lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.tokens = 0.0
+            self.paused_until = max(self.paused_until, monotonic() + delay)
+
+    def recover(self):
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 10)
+
 
-    if os.path.isfile(CHECKPOINT):
-        logger.info('Resume scraping from last check point.')
-        with open(CHECKPOINT, 'r') as f:
-            i = int(f.read())
+_local = threading.local()
+
+
+def fetch_video(bucket, vid, ts_ranges, started):
+    """
+    Fetch & label the transcript of a video, in a worker thread. The time
+    the fetch starts is written to started[vid]
+    """
+    # YouTubeTranscriptApi is not thread-safe, use one per thread
+    api = getattr(_local, 'api', None)
+    if api is None:
+        api = _local.api = YouTubeTranscriptApi()
+    bucket.acquire()
+    started[vid] = monotonic()
+    cap = pd.DataFrame(api.fetch(vid, languages=LANGUAGES))
+
+    cap['end'] = cap['start'] + cap['duration']
+    cap['label'] = label_snippets(cap.start, cap.end, ts_ranges)
+
+    return raw_values(cap)
+
+
+def get_transcripts(workers=8, rate=2.0, max_retries=MAX_RETRIES):
+    """
+    Scrape the transcripts of all videos with timestamps, `workers` at a time
+    and at most `rate` per second. Every finished video is appended to the
+    raw corpus right away, with its labelled snippets or the error class if
+    it has no transcript, so a rerun resumes exactly where the last one
+    stopped. Stops after max_retries consecutive blocks by YouTube, counting
+    the fetches blocked together, i.e. started before the last back off, once
+    """
+    timestamps = Corpus(TIMESTAMPS)
+    starts, ends = timestamps.arrays('start'), timestamps.arrays('end')
+    # reopening the corpus drops a record torn by a crash
+    store = CorpusWriter(RAW, RAW_COLUMNS)
+    done = set(Corpus(RAW).keys)
+    todo = deque((vid, np.stack([start, end], axis=1))
+                 for vid, start, end in zip(timestamps.keys, starts, ends)
+                 if vid not in done)
+    logger.info(f'{len(done)} videos scraped before, {len(todo)} to go')
+    del done
+
+    bucket = TokenBucket(rate)
+    blocks = scraped = missing = 0
+    pending = {}
+    started = {}
+    last_backoff = float('-inf')
+    with store, ThreadPoolExecutor(max_workers=workers) as executor:
+        while pending or (todo and blocks < max_retries):
+            # keep a bounded number of videos in flight
+            while todo and len(pending) < 2 * workers and blocks < max_retries:
+                vid, ts_ranges = todo.popleft()
+                future = executor.submit(fetch_video, bucket, vid, ts_ranges,
+                                         started)
+                pending[future] = (vid, ts_ranges)
+
+            finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                vid, ts_ranges = pending.pop(future)
+                t_start = started.pop(vid, float('-inf'))
+                try:
+                    values = future.result()
+                except Exception as e:
+                    error = type(e).__name__
+                    if error in BLOCKED_ERRORS and t_start < last_backoff:
+                        # blocked with the fetch that started the back off
+                        logger.debug(f'{error} on video id {vid}, already '
+                                     'backing off')
+                        todo.appendleft((vid, ts_ranges))
+                        continue
+                    if error in BLOCKED_ERRORS:
+                        blocks += 1
+                        last_backoff = monotonic()
+                        delay = min(MAX_BACKOFF, BACKOFF * 2 ** (blocks - 1))
+                        logger.info(f'{error} on video id {vid}, '
+                                    f'back off for {delay} seconds')
+                        bucket.backoff(delay)
+                        todo.appendleft((vid, ts_ranges))
+                        continue
+                    if error not in MISSING_ERRORS:
+                        # e.g. a network error, retried on the next run
+                        logger.debug(f'Cannot scrape video id {vid}: {error}')
+                        continue
+                    logger.debug(f'No transcript for video id {vid}: {error}')
+                    values = error_values(error)
+                    missing += 1
+                else:
+                    logger.debug(f'Scraped video id {vid}')
+                    if t_start > last_backoff:
+                        blocks = 0
+                        bucket.recover()
+                    scraped += 1
+
+                store.append(vid, **values)
+                store.flush()
+
+    if todo:
+        # most possibly hitting YouTube Transcript API's limit
+        logger.info(f'Reached retry limit, {len(todo)} videos left. Stopping...')
     else:
-        logger.info('Start transcript scraping')
-        i = 0
-    retries = 0
-    while True:
-        i += 1
-        if retries >= 10:
-            # most possibly hitting YouTube Transcript API's limit
-            logger.info('Reached retry limit. Stopping...')
-            break
-
-        vid = df_ts.videoID[i]
-        ts_ranges = df_ts.time[i]
-
-        if vid in raw.keys():
-            continue
-        elif i == df_ts.index[-1]:
-            logger.info('No more video to scrape. Stopping...')
-            break
-        else:
-            try:
-                cap = pd.DataFrame(YouTubeTranscriptApi().fetch(
-                    vid, languages=['en', 'en-US', 'en-GB']))
-                retries = 0
-                logger.debug(f'Scraped video id {vid}')
-            except:
-                retries += 1
-                logger.debug(f'Cannot scrape video id {vid}')
-                continue
-
-            cap['end'] = cap['start'] + cap['duration']
-            cap['label'] = 0
-            cap.drop(['duration'], axis=1, inplace=True)
-
-            for ts in eval(str(ts_ranges)):
-                mask = (cap.start >= ts[0]) & (cap.end <= ts[1])
-                cap.loc[mask, 'label'] = 1
-
-            raw[vid] = cap.to_json()
-
-    logger.info('Dumping data...')
-    with open(RAW_DATA, 'w') as f:
-        json.dump(raw, f)
-    with open(CHECKPOINT, 'w') as f:
-        f.write(str(i-MAX_RETRIES))
-    logger.info(f'Done. Raw data has {len(raw)} lines')
+        logger.info('No more video to scrape. Stopping...')
+    logger.info(f'Done. Scraped {scraped} transcripts, '
+                f'{missing} videos have none')
     logger.info('EXIT 0')
 
 
 def main():
-    get_timestamps()
-    get_transcripts()
+    parser = argparse.ArgumentParser(
+        description='Scrape the transcripts of SponsorBlock videos')
+    parser.add_argument('--workers', type=int, default=8,
+                        help='number of concurrent fetches')
+    parser.add_argument('--rate', type=float, default=2.0,
+                        help='maximum number of fetches per second')
+    parser.add_argument('--max-retries', type=int, default=MAX_RETRIES,
+                        help='stop after this many consecutive blocks')
+    parser.add_argument('--sponsor-times', default=SPONSOR_TIMES,
+                        help='URL or local path of the sponsorTimes.csv dump')
+    args = parser.parse_args()
+
+    # JSON files of earlier versions
+    convert()
+    get_timestamps(args.sponsor_times)
+    get_transcripts(args.workers, args.rate, args.max_retries)
 
 
 if __name__ == '__main__':
@@ -1,21 +1,20 @@
-import json
 import os
-import pickle
+from time import perf_counter
 
 import numpy as np
-import pandas as pd
+import tensorflow as tf
 from sklearn.model_selection import train_test_split
 from tensorflow.keras import optimizers
-from tensorflow.keras.callbacks import ReduceLROnPlateau
+from tensorflow.keras.callbacks import Callback, ReduceLROnPlateau
 from tensorflow.keras.initializers import Constant
 from tensorflow.keras.layers import (LSTM, Bidirectional, Dense, Embedding,
                                      SpatialDropout1D, TimeDistributed)
 from tensorflow.keras.models import Sequential
-from tensorflow.keras.preprocessing.sequence import pad_sequences
-from tensorflow.keras.preprocessing.text import tokenizer_from_json
-from tensorflow.keras.utils import to_categorical
 
+from .corpus import Corpus
+from .dataset import MAX_LEN, WindowStream, tokens_path
 from .logger import get_console_log, get_logger
+from .vectors import embedding_matrix_path
 
 work_dir = os.getcwd()
 data_dir = os.path.join(work_dir, 'data')
@@ -25,98 +24,78 @@ model_dir = os.path.join(work_dir, 'model')
 if not os.path.isdir(model_dir):
     os.makedirs(model_dir)
 
-TEXT_LABELS = os.path.join(data_dir, 'text_labels.json')
-EMBEDDING_MATRIX = os.path.join(data_dir, 'embedding_matrix.pkl')
 TOKENIZER = os.path.join(model_dir, 'tokenizer.json')
 MODEL_FILE = os.path.join(model_dir, 'model.h5')
 
-MAX_LEN = 3000
-OVERLAP = 800
+BATCH_SIZE = 32
+SHUFFLE_BUFFER = 512  # windows
+VALIDATION_SPLIT = 0.1
 
 logger = get_logger('main', 'trainer.log')
 _ = get_console_log()
 
 
-def get_split_index(len_arr, max_len, overlap):
-    if len_arr <= max_len:
-        return [[0, len_arr]]
-    else:
-        splits = [[0, max_len]]
-        i = 1
-        while True:
-            if ((max_len-overlap)*i+max_len) >= len_arr:
-                break
-            else:
-                splits.append(
-                    [(max_len-overlap)*i, ((max_len-overlap)*i+max_len)])
-            i += 1
-        splits.append([(max_len-overlap)*i, len_arr])
-
-        return splits
-
-
-def reshape_data(x, y, max_len, overlap):
-    """Splice x and y sequences into chunks of max_len
-    with overlap. Return padded array.
+def split_videos(n_videos):
     """
+    Split the videos of the token corpus into train, validation & test sets.
+    Train & test are the same split as before, the validation set is the
+    last VALIDATION_SPLIT of the train videos
+    """
+    train, test = train_test_split(
+        np.arange(n_videos), test_size=0.2, random_state=42, shuffle=True)
+    n_val = int(len(train) * VALIDATION_SPLIT)
+    return train[:len(train) - n_val], train[len(train) - n_val:], test
 
-    x_shaped = []
-    y_shaped = []
-
-    for i in range(len(x)):
-        if len(x) != len(y):
-            continue
-        elif len(x) < 5:
-            continue
-        else:
-            x_arr = x[i]
-            y_arr = y[i]
-            len_arr = len(x_arr)
 
-            splits = get_split_index(len_arr, max_len, overlap)
-            split_x = [np.array(x_arr[split[0]:split[1]],
-                                dtype='float64') for split in splits]
-            split_y = [np.array(y_arr[split[0]:split[1]],
-                                dtype='float64') for split in splits]
-            x_shaped.extend(split_x)
-            y_shaped.extend(split_y)
+def make_dataset(stream, weight, shuffle=False):
+    """
+    Batches of windows from a WindowStream, with one-hot labels and sample
+    weights of `weight + 1` for sponsor tokens and 1 for the others, as
+    before, built per batch. Windows are read by a background thread and
+    prefetched
+    """
+    dataset = tf.data.Dataset.from_generator(stream, output_signature=(
+        tf.TensorSpec((stream.max_len,), tf.int32),
+        tf.TensorSpec((stream.max_len,), tf.uint8)))
+    if shuffle:
+        dataset = dataset.shuffle(SHUFFLE_BUFFER)
 
-    x_shaped = pad_sequences(x_shaped, padding="post", maxlen=max_len)
-    y_shaped = pad_sequences(y_shaped, padding="post", maxlen=max_len)
+    def to_inputs(x, y):
+        labels = tf.cast(y, tf.float32)
+        return x, tf.one_hot(tf.cast(y, tf.int32), 2), labels * weight + 1
 
-    return x_shaped, y_shaped
+    return (dataset
+            .batch(BATCH_SIZE)
+            .map(to_inputs, num_parallel_calls=tf.data.AUTOTUNE)
+            .prefetch(tf.data.AUTOTUNE))
 
 
-def prepare_data():
-    with open(TEXT_LABELS, 'r') as f:
-        data = pd.DataFrame(json.loads(f.read()))
-    with open(TOKENIZER) as f:
-        json_obj = json.load(f)
-        tokenizer = tokenizer_from_json(json_obj)
+class Throughput(Callback):
+    """Log the training windows per second of every epoch"""
 
-    tokenized_x = tokenizer.texts_to_sequences(data.text.values)
-    x_train, x_test, y_train, y_test = train_test_split(
-        tokenized_x,
-        data.labels.values,
-        test_size=0.2,
-        random_state=42,
-        shuffle=True)
+    def __init__(self, n_windows):
+        super().__init__()
+        self.n_windows = n_windows
 
-    x_train, y_train = reshape_data(
-        x_train, y_train, max_len=MAX_LEN, overlap=OVERLAP)
+    def on_epoch_begin(self, epoch, logs=None):
+        self.start = self.end = perf_counter()
 
-    x_test, y_test = reshape_data(
-        x_test, y_test, max_len=MAX_LEN, overlap=OVERLAP)
+    def on_train_batch_end(self, batch, logs=None):
+        self.end = perf_counter()
 
-    return x_train, x_test, y_train, y_test
+    def on_epoch_end(self, epoch, logs=None):
+        seconds = max(self.end - self.start, 1e-9)
+        logger.info(f'Epoch {epoch + 1}: {self.n_windows} windows, '
+                    f'{self.n_windows / seconds:.1f} windows/s')
 
 
-def build_model():
-    embedding_matrix = pickle.load(open(EMBEDDING_MATRIX, "rb"))
+def build_model(input_length=MAX_LEN):
+    embedding_matrix = np.load(embedding_matrix_path(data_dir, TOKENIZER),
+                               mmap_mode='r')
     embedding = Embedding(input_dim=10000,
                           output_dim=300,
                           embeddings_initializer=Constant(embedding_matrix),
-                          input_length=MAX_LEN,
+                          input_length=input_length,
                           mask_zero=True,
                           trainable=False)
 
@@ -136,13 +115,23 @@ def build_model():
 
 def main():
     logger.info('Prepare data...')
-    x_train, x_test, y_train, y_test = prepare_data()
-    weight = (y_train.shape[0] * y_train.shape[1]) / y_train.sum()
-    train_weight_sample = y_train * weight + 1
-    test_weight_sample = y_test * weight + 1
-    y_train = to_categorical(y_train, 2)
-    y_test = to_categorical(y_test, 2)
-    logger.info('Done')
+    # tokenized by the preprocessor, read from disk as the model trains
+    tokens = tokens_path(TOKENIZER)
+    train, val, test = split_videos(len(Corpus(tokens)))
+    train_stream = WindowStream(tokens, train, shuffle=True)
+    val_stream = WindowStream(tokens, val)
+    test_stream = WindowStream(tokens, test)
+
+    # weighted over the train & validation windows, as before
+    train_all = WindowStream(tokens, np.concatenate([train, val]))
+    weight = len(train_all) * MAX_LEN / train_all.positives()
+    n_train = len(train_stream)
+    dropped = train_all.dropped + test_stream.dropped
+    if dropped:
+        logger.warning(f'Dropped {dropped} videos with misaligned tokens '
+                       'and labels')
+    logger.info(f'Done, {n_train} train, {len(val_stream)} validation & '
+                f'{len(test_stream)} test windows, sponsor weight {weight:.2f}')
 
     logger.info('Start training model')
     model = build_model()
@@ -156,19 +145,13 @@ def main():
                                   patience=3,
                                   min_lr=1e-8,
                                   verbose=1)
-    history = model.fit(x_train,
-                        y_train,
-                        validation_split=0.1,
+    history = model.fit(make_dataset(train_stream, weight, shuffle=True),
+                        validation_data=make_dataset(val_stream, weight),
                         epochs=25,
-                        sample_weight=train_weight_sample,
-                        batch_size=32,
                         verbose=1,
-                        callbacks=[reduce_lr])
+                        callbacks=[reduce_lr, Throughput(n_train)])
     test_loss, test_accuracy = model.evaluate(
-        x_test,
-        y_test,
-        batch_size=32,
-        sample_weight=test_weight_sample)
+        make_dataset(test_stream, weight))
     val_accuracy = history.history['val_accuracy'][-1]
     val_loss = history.history['val_loss'][-1]
     logger.info('Training finished')
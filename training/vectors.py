@@ -0,0 +1,72 @@
+"""
+Embedding matrix from the fastText word vectors, for the words of the
+tokenizer only. The .vec file is streamed line by line, and only the lines
+of words in the vocabulary are decoded & parsed, by numpy, so memory holds
+the matrix and little else. The matrix is cached as a float32 .npy file named
+after a hash of the tokenizer, which the trainer memory-maps.
+"""
+import hashlib
+import os
+
+import numpy as np
+
+EMBEDDING_DIM = 300
+
+
+def tokenizer_hash(path):
+    """Short hash of the tokenizer file, to key the files built from it"""
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()[:16]
+
+
+def embedding_matrix_path(directory, tokenizer_path):
+    return os.path.join(
+        directory, f'embedding_matrix_{tokenizer_hash(tokenizer_path)}.npy')
+
+
+def load_vectors(fname, words):
+    """
+    Stream a .vec file and return the float32 vectors of the given words,
+    by word. Lines of other words are skipped unparsed. A word listed twice
+    keeps its last vector, as in a dict of all the vectors
+    """
+    lines = {}
+    with open(fname, 'rb') as fin:
+        n, d = map(int, fin.readline().split())
+        for line in fin:
+            word, space, values = line.partition(b' ')
+            # invalid UTF-8 is dropped, as when decoding whole lines
+            word = word.decode('utf-8', 'ignore')
+            if not space:
+                word = word.rstrip()
+            if word in words:
+                lines[word] = values
+
+    vectors = {}
+    for word, values in lines.items():
+        vector = np.fromstring(values, np.float64, sep=' ')
+        if len(vector) != d:
+            raise ValueError(f'Vector of {word} has {len(vector)} values, '
+                             f'expected {d}')
+        vectors[word] = vector.astype(np.float32)
+    return vectors
+
+
+def embedding_matrix(fname, word_index, num_words,
+                     embedding_dim=EMBEDDING_DIM):
+    """
+    Return the float32 embedding matrix of the words with an id below
+    num_words in word_index, zeros for those without a vector
+    """
+    ids = {word: i for word, i in word_index.items() if i < num_words}
+    matrix = np.zeros((num_words, embedding_dim), np.float32)
+    for word, vector in load_vectors(fname, ids).items():
+        matrix[ids[word]] = vector
+    return matrix
+
+
+def save_atomic(path, matrix):
+    """Write the .npy file, which only appears once complete"""
+    with open(path + '.tmp', 'wb') as f:
+        np.save(f, matrix)
+    os.replace(path + '.tmp', path)